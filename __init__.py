@@ -5,7 +5,13 @@ from lnbits.tasks import create_permanent_unique_task
 from loguru import logger
 
 from .crud import db
-from .tasks import wait_for_paid_invoices
+from .tasks import (
+    invoice_pool,
+    refresh_exchange_rates,
+    shipment_writer,
+    wait_for_paid_invoices,
+    write_shipments,
+)
 from .views import shipping_generic_router
 from .views_api import shipping_api_router
 
@@ -24,7 +30,9 @@ shipping_static_files = [
 scheduled_tasks: list[asyncio.Task] = []
 
 
-def shipping_stop():
+async def shipping_stop():
+    await invoice_pool.drain()
+    await shipment_writer.flush()
     for task in scheduled_tasks:
         try:
             task.cancel()
@@ -35,6 +43,10 @@ def shipping_stop():
 def shipping_start():
     task = create_permanent_unique_task("ext_shipping", wait_for_paid_invoices)
     scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_shipping_shipments", write_shipments)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_shipping_rates", refresh_exchange_rates)
+    scheduled_tasks.append(task)
 
 
 __all__ = [
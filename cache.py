@@ -0,0 +1,234 @@
+# Description: In-memory caches for compiled per-user shipping configuration.
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Generic, TypeVar
+from uuid import uuid4
+
+from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
+from loguru import logger
+
+from .models import CacheStats, PricingSnapshot
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A small LRU cache with a size cap and a per-entry time to live.
+    Entries are evicted when they expire or when the cache grows past `maxsize`.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K) -> V | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> CacheStats:
+        return CacheStats(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl, hits=self.hits, misses=self.misses)
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Coalesces concurrent calls for the same key into one in-flight call
+    whose result, or exception, every caller receives.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[K, asyncio.Future[V]] = {}
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(func())
+            self._calls[key] = call
+            call.add_done_callback(lambda done: self._forget(key, done))
+        # a cancelled caller must not cancel the call the others are waiting on
+        return await asyncio.shield(call)
+
+    def _forget(self, key: K, call: asyncio.Future[V]) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._calls
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class RateCache:
+    """
+    Sats per unit of fiat, keyed by currency and filled by `provider`.
+    `get` only reads memory: a rate older than `max_age` is still served while
+    it is refreshed in the background (stale-while-revalidate), a rate older
+    than `max_stale` is dropped. After a failed fetch `get` does not call the
+    provider for that currency for `retry_after` seconds. Currencies are
+    remembered once asked for and kept fresh by `run`.
+    """
+
+    def __init__(
+        self,
+        provider: Callable[[str], Awaitable[float]],
+        max_age: float,
+        max_stale: float,
+        retry_after: float,
+    ):
+        self.provider = provider
+        self.max_age = max_age
+        self.max_stale = max_stale
+        self.retry_after = retry_after
+        self._rates: dict[str, tuple[float, float]] = {}
+        self._retry_at: dict[str, float] = {}
+        self._currencies: set[str] = set()
+        self._fetches: SingleFlight[str, float] = SingleFlight()
+        self._background: set[asyncio.Task] = set()
+
+    def get(self, currency: str) -> float | None:
+        currency = currency.upper()
+        self._currencies.add(currency)
+        item = self._rates.get(currency)
+        if item is None:
+            self._revalidate(currency)
+            return None
+        fetched_at, rate = item
+        age = time.monotonic() - fetched_at
+        if age > self.max_stale:
+            del self._rates[currency]
+            self._revalidate(currency)
+            return None
+        if age > self.max_age:
+            self._revalidate(currency)
+        return rate
+
+    async def refresh(self, currency: str) -> float:
+        currency = currency.upper()
+        self._currencies.add(currency)
+        return await self._fetches.do(currency, lambda: self._fetch(currency))
+
+    async def _fetch(self, currency: str) -> float:
+        try:
+            rate = await self.provider(currency)
+        except Exception:
+            self._retry_at[currency] = time.monotonic() + self.retry_after
+            raise
+        self._retry_at.pop(currency, None)
+        self._rates[currency] = (time.monotonic(), rate)
+        return rate
+
+    async def refresh_all(self) -> None:
+        for currency in list(self._currencies):
+            try:
+                await self.refresh(currency)
+            except Exception as exc:
+                logger.warning(f"Could not refresh the {currency} exchange rate: {exc}")
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(interval)
+
+    def _revalidate(self, currency: str) -> None:
+        if currency in self._fetches or time.monotonic() < self._retry_at.get(currency, 0):
+            return
+        task = asyncio.create_task(self._refresh_quietly(currency))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _refresh_quietly(self, currency: str) -> None:
+        try:
+            await self.refresh(currency)
+        except Exception as exc:
+            logger.warning(f"Could not fetch the {currency} exchange rate: {exc}")
+
+    def clear(self) -> None:
+        self._rates.clear()
+        self._retry_at.clear()
+        self._currencies.clear()
+
+
+PRICING_CACHE_MAXSIZE = 1024
+PRICING_CACHE_TTL = 300
+
+pricing_cache: LRUCache[str, PricingSnapshot] = LRUCache(maxsize=PRICING_CACHE_MAXSIZE, ttl=PRICING_CACHE_TTL)
+# keyed by (user_id, config version), so a load started before a write is not shared after it
+snapshot_loads: SingleFlight[tuple[str, int], PricingSnapshot] = SingleFlight()
+
+QUOTE_CACHE_MAXSIZE = int(os.getenv("SHIPPING_QUOTE_CACHE_SIZE", "10000"))
+QUOTE_CACHE_TTL = float(os.getenv("SHIPPING_QUOTE_CACHE_TTL", "300"))
+
+# keyed by (user_id, config version, region, weight key, method), see `price_weight_key`
+quote_cache: LRUCache[tuple, dict] = LRUCache(maxsize=QUOTE_CACHE_MAXSIZE, ttl=QUOTE_CACHE_TTL)
+
+_config_versions: dict[str, int] = {}
+
+# Versions restart at zero with the process, the epoch keeps old ETags from matching.
+CONFIG_EPOCH = uuid4().hex[:8]
+
+
+def config_version(user_id: str) -> int:
+    return _config_versions.get(user_id, 0)
+
+
+def invalidate_user_config(user_id: str) -> None:
+    """
+    Must be called after every write to a user's settings, regions or methods.
+    """
+    _config_versions[user_id] = config_version(user_id) + 1
+    pricing_cache.pop(user_id)
+
+
+def config_etag(user_id: str, variant: str = "") -> str:
+    """
+    Weak ETag for the user's configuration. Users at the same version get
+    different tags, `variant` separates responses built from the same
+    configuration, e.g. different list queries.
+    """
+    digest = hashlib.sha256(f"{user_id}\n{variant}".encode()).hexdigest()[:16]
+    return f'W/"{CONFIG_EPOCH}-{config_version(user_id)}-{digest}"'
+
+
+RATE_REFRESH_INTERVAL = float(os.getenv("SHIPPING_RATE_REFRESH_SECONDS", "60"))
+RATE_MAX_AGE = float(os.getenv("SHIPPING_RATE_MAX_AGE_SECONDS", "120"))
+RATE_MAX_STALE = float(os.getenv("SHIPPING_RATE_MAX_STALE_SECONDS", "1800"))
+RATE_RETRY_AFTER = float(os.getenv("SHIPPING_RATE_RETRY_AFTER_SECONDS", "30"))
+
+rate_cache = RateCache(
+    get_fiat_rate_satoshis, max_age=RATE_MAX_AGE, max_stale=RATE_MAX_STALE, retry_after=RATE_RETRY_AFTER
+)
@@ -1,27 +1,267 @@
 # Description: This file contains the CRUD operations for talking to the database.
 
-
-from lnbits.db import Database, Filters, Page
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections.abc import AsyncIterator
+from datetime import datetime, timezone
+from typing import Any, TypeVar
+
+from lnbits.db import (
+    SQLITE,
+    Connection,
+    Database,
+    Filters,
+    Page,
+    dict_to_model,
+    insert_query,
+    model_to_dict,
+    update_query,
+)
 from lnbits.helpers import urlsafe_short_hash
+from sqlalchemy import text
 
+from .cache import invalidate_user_config
 from .models import (
     CreateMethod,
     CreateRegions,
+    CursorPage,
     ExtensionSettings,  #
     Method,
     MethodFilters,
     Regions,
     RegionsFilters,
+    Shipment,
+    UserConfig,
     UserExtensionSettings,  #
+    WeightBand,
+    sort_weight_bands,
 )
 
 db = Database("ext_shipping")
 
+TModel = TypeVar("TModel", Regions, Method)
+
+EXPORT_CHUNK_SIZE = 500
+
+
+async def _execute_in_transaction(statements: list[tuple[str, dict | list[dict]]]) -> None:
+    """
+    Run all statements on one connection and commit once.
+    A list of values executes the statement once per item (executemany).
+    """
+    async with db.connect() as conn:
+        await _execute_statements(conn, statements)
+
+
+async def _execute_statements(conn: Connection, statements: list[tuple[str, dict | list[dict]]]) -> None:
+    for query, values in statements:
+        if isinstance(values, list) and not values:
+            continue
+        await conn.conn.execute(text(conn.rewrite_query(query)), values)
+    await conn.conn.commit()
+
+
+def _in_values(prefix: str, items: list[str]) -> tuple[str, dict]:
+    values = {f"{prefix}_{i}": item for i, item in enumerate(items)}
+    return ", ".join(f":{key}" for key in values), values
+
+
+def _region_assignments_insert(regions_list: list[Regions]) -> tuple[str, list[dict]]:
+    return (
+        """
+            INSERT INTO shipping.region_assignments (user_id, region_name, regions_id)
+            VALUES (:user_id, :region_name, :regions_id)
+        """,
+        [
+            {"user_id": regions.user_id, "region_name": name, "regions_id": regions.id}
+            for regions in regions_list
+            for name in dict.fromkeys(regions.regions)
+        ],
+    )
+
+
+def _weight_bands_insert(regions_list: list[Regions]) -> tuple[str, list[dict]]:
+    return (
+        """
+            INSERT INTO shipping.weight_bands (regions_id, user_id, max_weight, price, price_per_g)
+            VALUES (:regions_id, :user_id, :max_weight, :price, :price_per_g)
+        """,
+        [
+            {**band.dict(), "regions_id": regions.id, "user_id": regions.user_id}
+            for regions in regions_list
+            for band in regions.weight_bands
+        ],
+    )
+
+
+async def _with_weight_bands(regions_list: list[Regions], user_id: str | None = None) -> list[Regions]:
+    """
+    Attach the weight bands to the pricing rules with a single query.
+    """
+    if not regions_list:
+        return regions_list
+    if user_id:
+        query = "SELECT * FROM shipping.weight_bands WHERE user_id = :user_id"
+        values = {"user_id": user_id}
+    else:
+        placeholders, values = _in_values("regions_id", [regions.id for regions in regions_list])
+        query = f"SELECT * FROM shipping.weight_bands WHERE regions_id IN ({placeholders})"
+    rows: list[dict] = await db.fetchall(query, values)
+    return _attach_weight_bands(regions_list, rows)
+
+
+def _attach_weight_bands(regions_list: list[Regions], rows: list[dict]) -> list[Regions]:
+    bands: dict[str, list[WeightBand]] = {}
+    for row in rows:
+        bands.setdefault(row["regions_id"], []).append(WeightBand(**row))
+    for regions in regions_list:
+        regions.weight_bands = sort_weight_bands(bands.get(regions.id, []))
+    return regions_list
+
+
+def _encode_cursor(sortby: str, direction: str, value: Any, row_id: str) -> str:
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        value = value.timestamp()
+    payload = json.dumps([sortby, direction, value, row_id], separators=(",", ":"))
+    return urlsafe_b64encode(payload.encode()).decode()
+
+
+def _decode_cursor(cursor: str, sortby: str, direction: str) -> tuple[Any, str]:
+    try:
+        cursor_sortby, cursor_direction, value, row_id = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as exc:
+        raise ValueError("Invalid cursor.") from exc
+    if (cursor_sortby, cursor_direction) != (sortby, direction):
+        raise ValueError("Cursor does not match the requested sort order.")
+    return value, row_id
+
+
+async def _fetch_cursor_page(
+    table: str,
+    model: type[TModel],
+    sort_fields: list[str],
+    where: list[str],
+    values: dict,
+    filters: Filters | None,
+    cursor: str,
+    include_total: bool = False,
+) -> CursorPage[TModel]:
+    """
+    Keyset pagination ordered by (sort field, id).
+    An empty `cursor` starts at the first page, `offset` is ignored.
+    """
+    filters = filters or Filters()
+    sortby = filters.sortby or "created_at"
+    if sortby not in sort_fields:
+        raise ValueError(f"Cursor pagination cannot sort by '{sortby}'.")
+    direction = filters.direction or "asc"
+    limit = min(1000, filters.limit or 10)
+
+    total = None
+    if include_total:
+        row: dict = await db.fetchone(
+            f"SELECT COUNT(*) AS count FROM {table} {filters.where(list(where))}",
+            filters.values(values),
+        )
+        total = int(row["count"])
+
+    keyset_where = list(where)
+    values = filters.values(values)
+    if cursor:
+        values["cursor_value"], values["cursor_id"] = _decode_cursor(cursor, sortby, direction)
+        operator = ">" if direction == "asc" else "<"
+        placeholder = ":cursor_value"
+        if model.__fields__[sortby].type_ is datetime:
+            placeholder = db.timestamp_placeholder("cursor_value")
+        keyset_where.append(
+            f"({sortby} {operator} {placeholder} OR ({sortby} = {placeholder} AND id {operator} :cursor_id))"
+        )
+
+    rows: list[dict] = await db.fetchall(
+        f"""
+            SELECT * FROM {table} {filters.where(keyset_where)}
+            ORDER BY {sortby} {direction}, id {direction}
+            LIMIT {limit + 1}
+        """,
+        values,
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(sortby, direction, rows[-1][sortby], rows[-1]["id"])
+    return CursorPage(
+        data=[dict_to_model(row, model) for row in rows],
+        total=total,
+        next_cursor=next_cursor,
+    )
+
+
+def _json_rows(value: Any) -> list[dict]:
+    if isinstance(value, str):
+        value = json.loads(value)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+async def get_user_config(user_id: str) -> UserConfig:
+    """
+    Settings, regions with their weight bands and methods over one connection.
+    Postgres returns everything in a single statement as JSON aggregates.
+    """
+    values = {"user_id": user_id}
+    if db.type != SQLITE:
+        row: dict = await db.fetchone(
+            """
+                SELECT
+                    (SELECT row_to_json(s) FROM shipping.extension_settings s
+                     WHERE s.id = :user_id) AS settings,
+                    (SELECT json_agg(r ORDER BY r.created_at, r.id) FROM shipping.regions r
+                     WHERE r.user_id = :user_id) AS regions,
+                    (SELECT json_agg(b) FROM shipping.weight_bands b
+                     WHERE b.user_id = :user_id) AS weight_bands,
+                    (SELECT json_agg(m ORDER BY m.created_at, m.id) FROM shipping.methods m
+                     WHERE m.user_id = :user_id) AS methods
+            """,
+            values,
+        )
+        settings_rows = _json_rows(row["settings"])
+        settings = dict_to_model(settings_rows[0], ExtensionSettings) if settings_rows else None
+        regions_list = [dict_to_model(item, Regions) for item in _json_rows(row["regions"])]
+        band_rows = _json_rows(row["weight_bands"])
+        methods = [dict_to_model(item, Method) for item in _json_rows(row["methods"])]
+    else:
+        async with db.connect() as conn:
+            settings = await conn.fetchone(
+                "SELECT * FROM shipping.extension_settings WHERE id = :user_id", values, ExtensionSettings
+            )
+            regions_list = await conn.fetchall(
+                "SELECT * FROM shipping.regions WHERE user_id = :user_id ORDER BY created_at, id", values, Regions
+            )
+            band_rows = await conn.fetchall("SELECT * FROM shipping.weight_bands WHERE user_id = :user_id", values)
+            methods = await conn.fetchall(
+                "SELECT * FROM shipping.methods WHERE user_id = :user_id ORDER BY created_at, id", values, Method
+            )
+    return UserConfig(
+        settings=settings,
+        regions=_attach_weight_bands(regions_list, band_rows),
+        methods=methods,
+    )
+
 
 ########################### Regions ############################
 async def create_regions(user_id: str, data: CreateRegions) -> Regions:
     regions = Regions(**data.dict(), id=urlsafe_short_hash(), user_id=user_id)
-    await db.insert("shipping.regions", regions)
+    await _execute_in_transaction(
+        [
+            _region_assignments_insert([regions]),
+            (insert_query("shipping.regions", regions), model_to_dict(regions)),
+            _weight_bands_insert([regions]),
+        ]
+    )
+    invalidate_user_config(user_id)
     return regions
 
 
@@ -29,7 +269,7 @@ async def get_regions(
     user_id: str,
     regions_id: str,
 ) -> Regions | None:
-    return await db.fetchone(
+    regions = await db.fetchone(
         """
             SELECT * FROM shipping.regions
             WHERE id = :id AND user_id = :user_id
@@ -37,12 +277,15 @@ async def get_regions(
         {"id": regions_id, "user_id": user_id},
         Regions,
     )
+    if regions:
+        await _with_weight_bands([regions])
+    return regions
 
 
 async def get_regions_by_id(
     regions_id: str,
 ) -> Regions | None:
-    return await db.fetchone(
+    regions = await db.fetchone(
         """
             SELECT * FROM shipping.regions
             WHERE id = :id
@@ -50,6 +293,9 @@ async def get_regions_by_id(
         {"id": regions_id},
         Regions,
     )
+    if regions:
+        await _with_weight_bands([regions])
+    return regions
 
 
 async def get_regions_ids_by_user(
@@ -76,17 +322,39 @@ async def get_regions_paginated(
         where.append("user_id = :user_id")
         values["user_id"] = user_id
 
-    return await db.fetch_page(
+    page = await db.fetch_page(
         "SELECT * FROM shipping.regions",
         where=where,
         values=values,
         filters=filters,
         model=Regions,
     )
+    await _with_weight_bands(page.data)
+    return page
+
+
+async def get_regions_cursor_page(
+    user_id: str,
+    filters: Filters[RegionsFilters] | None = None,
+    cursor: str = "",
+    include_total: bool = False,
+) -> CursorPage[Regions]:
+    page = await _fetch_cursor_page(
+        "shipping.regions",
+        Regions,
+        RegionsFilters.__cursor_sort_fields__,
+        ["user_id = :user_id"],
+        {"user_id": user_id},
+        filters,
+        cursor,
+        include_total,
+    )
+    await _with_weight_bands(page.data)
+    return page
 
 
 async def get_regions_by_user(user_id: str) -> list[Regions]:
-    return await db.fetchall(
+    regions_list = await db.fetchall(
         """
             SELECT * FROM shipping.regions
             WHERE user_id = :user_id
@@ -94,21 +362,156 @@ async def get_regions_by_user(user_id: str) -> list[Regions]:
         {"user_id": user_id},
         Regions,
     )
+    return await _with_weight_bands(regions_list, user_id=user_id)
+
+
+async def stream_regions_by_user(user_id: str) -> AsyncIterator[Regions]:
+    """
+    Stream the user's pricing rules with their weight bands attached, in keyset
+    chunks. Each chunk takes the database lock only while it is read, never
+    while the consumer (e.g. a slow download) holds the generator.
+    """
+    filters = Filters(sortby="created_at", limit=EXPORT_CHUNK_SIZE, model=RegionsFilters)
+    cursor = ""
+    while True:
+        page = await get_regions_cursor_page(user_id, filters, cursor)
+        for regions in page.data:
+            yield regions
+        if not page.next_cursor:
+            return
+        cursor = page.next_cursor
+
+
+async def get_assigned_region_names(
+    user_id: str,
+    region_names: list[str],
+    exclude_regions_id: str | None = None,
+) -> list[str]:
+    """
+    Return the region names already assigned to another pricing rule of the user.
+    """
+    if not region_names:
+        return []
+    placeholders, values = _in_values("region", region_names)
+    rows: list[dict] = await db.fetchall(
+        f"""
+            SELECT region_name FROM shipping.region_assignments
+            WHERE user_id = :user_id AND region_name IN ({placeholders})
+            AND regions_id != :exclude_regions_id
+        """,
+        {**values, "user_id": user_id, "exclude_regions_id": exclude_regions_id or ""},
+    )
+    return [row["region_name"] for row in rows]
+
+
+async def get_region_assignments(user_id: str) -> dict[str, str]:
+    """
+    Map every region name the user has assigned to its pricing rule id.
+    """
+    rows: list[dict] = await db.fetchall(
+        """
+            SELECT region_name, regions_id FROM shipping.region_assignments
+            WHERE user_id = :user_id
+        """,
+        {"user_id": user_id},
+    )
+    return {row["region_name"]: row["regions_id"] for row in rows}
+
+
+async def get_existing_regions_ids(user_id: str, regions_ids: list[str]) -> set[str]:
+    if not regions_ids:
+        return set()
+    placeholders, values = _in_values("regions_id", regions_ids)
+    rows: list[dict] = await db.fetchall(
+        f"""
+            SELECT id FROM shipping.regions
+            WHERE user_id = :user_id AND id IN ({placeholders})
+        """,
+        {**values, "user_id": user_id},
+    )
+    return {row["id"] for row in rows}
 
 
 async def update_regions(data: Regions) -> Regions:
-    await db.update("shipping.regions", data)
+    await _execute_in_transaction(
+        [
+            (
+                "DELETE FROM shipping.region_assignments WHERE regions_id = :id AND user_id = :user_id",
+                {"id": data.id, "user_id": data.user_id},
+            ),
+            _region_assignments_insert([data]),
+            (update_query("shipping.regions", data), model_to_dict(data)),
+            (
+                "DELETE FROM shipping.weight_bands WHERE regions_id = :id AND user_id = :user_id",
+                {"id": data.id, "user_id": data.user_id},
+            ),
+            _weight_bands_insert([data]),
+        ]
+    )
+    invalidate_user_config(data.user_id)
     return data
 
 
 async def delete_regions(user_id: str, regions_id: str) -> None:
-    await db.execute(
-        """
-            DELETE FROM shipping.regions
-            WHERE id = :id AND user_id = :user_id
-        """,
-        {"id": regions_id, "user_id": user_id},
-    )
+    """
+    Also removes the rule from the methods restricted to it. Raises ValueError
+    if a method is restricted to this rule only, as no regions would make the
+    method available everywhere.
+    """
+    values = {"id": regions_id, "user_id": user_id}
+    async with db.connect() as conn:
+        # ids can contain `_`, the LIKE only narrows the rows down
+        methods = await conn.fetchall(
+            "SELECT * FROM shipping.methods WHERE user_id = :user_id AND regions LIKE :pattern",
+            {"user_id": user_id, "pattern": f'%"{regions_id}"%'},
+            Method,
+        )
+        methods = [method for method in methods if regions_id in method.regions]
+        for method in methods:
+            if method.regions == [regions_id]:
+                raise ValueError(f"Method '{method.title}' is only available in this region.")
+            method.regions = [item for item in method.regions if item != regions_id]
+        await _execute_statements(
+            conn,
+            [
+                *[(update_query("shipping.methods", method), model_to_dict(method)) for method in methods],
+                (
+                    "DELETE FROM shipping.region_assignments WHERE regions_id = :id AND user_id = :user_id",
+                    values,
+                ),
+                (
+                    "DELETE FROM shipping.weight_bands WHERE regions_id = :id AND user_id = :user_id",
+                    values,
+                ),
+                (
+                    """
+                        DELETE FROM shipping.regions
+                        WHERE id = :id AND user_id = :user_id
+                    """,
+                    values,
+                ),
+            ],
+        )
+    invalidate_user_config(user_id)
+
+
+async def create_regions_and_methods(user_id: str, regions_list: list[Regions], methods: list[Method]) -> None:
+    """
+    Insert pricing rules and methods with batched writes in a single transaction.
+    Nothing is written if any statement fails.
+    """
+    statements: list[tuple[str, dict | list[dict]]] = [
+        _region_assignments_insert(regions_list),
+        _weight_bands_insert(regions_list),
+    ]
+    if regions_list:
+        statements.append(
+            (insert_query("shipping.regions", regions_list[0]), [model_to_dict(regions) for regions in regions_list])
+        )
+    if methods:
+        statements.append((insert_query("shipping.methods", methods[0]), [model_to_dict(method) for method in methods]))
+    await _execute_in_transaction(statements)
+    invalidate_user_config(user_id)
 
 
 ################################# Methods ###########################
@@ -117,6 +520,7 @@ async def delete_regions(user_id: str, regions_id: str) -> None:
 async def create_method(user_id: str, data: CreateMethod) -> Method:
     method = Method(**data.dict(), id=urlsafe_short_hash(), user_id=user_id)
     await db.insert("shipping.methods", method)
+    invalidate_user_config(user_id)
     return method
 
 
@@ -160,6 +564,21 @@ async def get_methods_by_user(
     )
 
 
+async def stream_methods_by_user(user_id: str) -> AsyncIterator[Method]:
+    """
+    Like `stream_regions_by_user`, no connection is held between chunks.
+    """
+    filters = Filters(sortby="created_at", limit=EXPORT_CHUNK_SIZE, model=MethodFilters)
+    cursor = ""
+    while True:
+        page = await get_methods_cursor_page(user_id, filters, cursor)
+        for method in page.data:
+            yield method
+        if not page.next_cursor:
+            return
+        cursor = page.next_cursor
+
+
 async def get_methods_paginated(
     user_id: str | None = None,
     filters: Filters[MethodFilters] | None = None,
@@ -179,8 +598,27 @@ async def get_methods_paginated(
     )
 
 
+async def get_methods_cursor_page(
+    user_id: str,
+    filters: Filters[MethodFilters] | None = None,
+    cursor: str = "",
+    include_total: bool = False,
+) -> CursorPage[Method]:
+    return await _fetch_cursor_page(
+        "shipping.methods",
+        Method,
+        MethodFilters.__cursor_sort_fields__,
+        ["user_id = :user_id"],
+        {"user_id": user_id},
+        filters,
+        cursor,
+        include_total,
+    )
+
+
 async def update_method(data: Method) -> Method:
     await db.update("shipping.methods", data)
+    invalidate_user_config(data.user_id)
     return data
 
 
@@ -192,15 +630,44 @@ async def delete_method(user_id: str, method_id: str) -> None:
         """,
         {"id": method_id, "user_id": user_id},
     )
+    invalidate_user_config(user_id)
+
+
+############################ Shipments ############################
+async def create_shipments(shipments: list[Shipment]) -> None:
+    """
+    Insert a batch of shipments in one transaction.
+    Payment hashes that are already recorded are skipped.
+    """
+    if not shipments:
+        return
+    await _execute_in_transaction(
+        [
+            (
+                f"{insert_query('shipping.shipments', shipments[0])} ON CONFLICT (payment_hash) DO NOTHING",
+                [model_to_dict(shipment) for shipment in shipments],
+            )
+        ]
+    )
 
 
-############################ Settings #############################
-async def create_extension_settings(user_id: str, data: ExtensionSettings) -> ExtensionSettings:
-    settings = UserExtensionSettings(**data.dict(), id=user_id)
-    await db.insert("shipping.extension_settings", settings)
-    return settings
+async def get_shipment(payment_hash: str) -> Shipment | None:
+    return await db.fetchone(
+        "SELECT * FROM shipping.shipments WHERE payment_hash = :payment_hash",
+        {"payment_hash": payment_hash},
+        Shipment,
+    )
+
 
+async def get_shipments_by_user(user_id: str) -> list[Shipment]:
+    return await db.fetchall(
+        "SELECT * FROM shipping.shipments WHERE user_id = :user_id ORDER BY created_at DESC",
+        {"user_id": user_id},
+        Shipment,
+    )
 
+
+############################ Settings #############################
 async def get_extension_settings(
     user_id: str,
 ) -> ExtensionSettings | None:
@@ -214,7 +681,17 @@ async def get_extension_settings(
     )
 
 
-async def update_extension_settings(user_id: str, data: ExtensionSettings) -> ExtensionSettings:
+async def upsert_extension_settings(user_id: str, data: ExtensionSettings) -> ExtensionSettings:
     settings = UserExtensionSettings(**data.dict(), id=user_id)
-    await db.update("shipping.extension_settings", settings)
+    await db.execute(
+        f"""
+            {insert_query("shipping.extension_settings", settings)}
+            ON CONFLICT (id) DO UPDATE SET
+                currency = excluded.currency,
+                available_regions = excluded.available_regions,
+                updated_at = excluded.updated_at
+        """,
+        model_to_dict(settings),
+    )
+    invalidate_user_config(user_id)
     return settings
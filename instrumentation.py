@@ -0,0 +1,252 @@
+# Description: Opt-in request instrumentation for the shipping routers.
+# Adds a Server-Timing header with per-phase durations and the DB query count,
+# and keeps per-endpoint latency histograms for the metrics endpoint.
+# Enable with SHIPPING_INSTRUMENTATION=true or `set_instrumentation(True)`.
+
+import os
+import time
+from bisect import bisect_left
+from collections.abc import Callable, Coroutine
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Any
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from .crud import db
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class RequestTiming:
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = {}
+        self.queries = 0
+        self.db_time = 0.0
+        self.endpoint_start: float | None = None
+        self.endpoint_end: float | None = None
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        items = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.phases.items()]
+        items.append(f'db;dur={self.db_time * 1000:.3f};desc="{self.queries} queries"')
+        items.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(items)
+
+
+class _Phase:
+    def __init__(self, timing: RequestTiming, name: str):
+        self.timing = timing
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_exc: object) -> None:
+        self.timing.add(self.name, time.perf_counter() - self.start)
+
+
+class EndpointMetrics:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.queries = 0
+        # not cumulative, one slot per bucket plus one for +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds: float, queries: int) -> None:
+        self.count += 1
+        self.total += seconds
+        self.queries += queries
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def cumulative_buckets(self) -> list[tuple[str, int]]:
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+        counts = []
+        running = 0
+        for bound, count in zip(bounds, self.buckets, strict=True):
+            running += count
+            counts.append((bound, running))
+        return counts
+
+
+_current_timing: ContextVar[RequestTiming | None] = ContextVar("shipping_request_timing", default=None)
+_enabled = os.getenv("SHIPPING_INSTRUMENTATION", "false").lower() in ("1", "true", "yes")
+_listening = False
+endpoint_metrics: dict[tuple[str, str], EndpointMetrics] = {}
+_NO_PHASE = nullcontext()
+
+
+def instrumentation_enabled() -> bool:
+    return _enabled
+
+
+def set_instrumentation(enabled: bool) -> None:
+    global _enabled
+    _enabled = enabled
+    if enabled:
+        _listen_for_queries()
+
+
+def reset_metrics() -> None:
+    endpoint_metrics.clear()
+
+
+def phase(name: str) -> _Phase | nullcontext:
+    """
+    Time a block as a Server-Timing phase of the current request.
+    Does nothing outside an instrumented request.
+    """
+    timing = _current_timing.get()
+    if timing is None:
+        return _NO_PHASE
+    return _Phase(timing, name)
+
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany) -> None:
+    if _current_timing.get() is not None:
+        conn.info.setdefault("shipping_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany) -> None:
+    timing = _current_timing.get()
+    starts = conn.info.get("shipping_query_start")
+    if timing is not None and starts:
+        timing.queries += 1
+        timing.db_time += time.perf_counter() - starts.pop()
+
+
+def _listen_for_queries() -> None:
+    global _listening
+    if _listening:
+        return
+    event.listen(db.engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(db.engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    _listening = True
+
+
+def _timed_endpoint(endpoint: Callable) -> Callable:
+    """
+    Marks where the endpoint starts and ends, so the time around it can be split
+    into request handling (auth, parsing) and response serialization.
+    """
+    if getattr(endpoint, "__shipping_timed__", False):
+        return endpoint
+
+    def _start() -> RequestTiming | None:
+        timing = _current_timing.get()
+        if timing is not None:
+            timing.endpoint_start = time.perf_counter()
+        return timing
+
+    def _end(timing: RequestTiming | None) -> None:
+        if timing is not None:
+            timing.endpoint_end = time.perf_counter()
+
+    timed: Callable
+    if iscoroutinefunction(endpoint):
+
+        @wraps(endpoint)
+        async def timed_async(*args, **kwargs):
+            timing = _start()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _end(timing)
+
+        timed = timed_async
+    else:
+
+        @wraps(endpoint)
+        def timed_sync(*args, **kwargs):
+            timing = _start()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                _end(timing)
+
+        timed = timed_sync
+    timed.__shipping_timed__ = True  # type: ignore[attr-defined]
+    return timed
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    Route class for the shipping routers. Costs one flag check per request
+    while instrumentation is disabled.
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any) -> None:
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def instrumented_handler(request: Request) -> Response:
+            if not _enabled:
+                return await handler(request)
+            timing = RequestTiming()
+            token = _current_timing.set(timing)
+            start = time.perf_counter()
+            try:
+                response = await handler(request)
+            finally:
+                _current_timing.reset(token)
+                end = time.perf_counter()
+                metrics = endpoint_metrics.setdefault((request.method, self.path_format), EndpointMetrics())
+                metrics.observe(end - start, timing.queries)
+            if timing.endpoint_start is not None and timing.endpoint_end is not None:
+                timing.add("request", timing.endpoint_start - start)
+                timing.add("serialize", end - timing.endpoint_end)
+            response.headers["Server-Timing"] = timing.server_timing(end - start)
+            return response
+
+        return instrumented_handler
+
+
+def metrics_json() -> dict:
+    return {
+        "enabled": _enabled,
+        "endpoints": [
+            {
+                "method": method,
+                "route": route,
+                "count": metrics.count,
+                "sum": metrics.total,
+                "queries": metrics.queries,
+                "buckets": dict(metrics.cumulative_buckets()),
+            }
+            for (method, route), metrics in sorted(endpoint_metrics.items())
+        ],
+    }
+
+
+def metrics_prometheus() -> str:
+    lines = [
+        "# HELP shipping_request_duration_seconds Shipping API request latency.",
+        "# TYPE shipping_request_duration_seconds histogram",
+    ]
+    for (method, route), metrics in sorted(endpoint_metrics.items()):
+        labels = f'method="{method}",route="{route}"'
+        for bound, count in metrics.cumulative_buckets():
+            lines.append(f'shipping_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f"shipping_request_duration_seconds_sum{{{labels}}} {metrics.total}")
+        lines.append(f"shipping_request_duration_seconds_count{{{labels}}} {metrics.count}")
+    lines += [
+        "# HELP shipping_db_queries_total Database queries run by shipping API requests.",
+        "# TYPE shipping_db_queries_total counter",
+    ]
+    for (method, route), metrics in sorted(endpoint_metrics.items()):
+        lines.append(f'shipping_db_queries_total{{method="{method}",route="{route}"}} {metrics.queries}')
+    return "\n".join(lines) + "\n"
+
+
+if _enabled:
+    _listen_for_queries()
@@ -2,6 +2,11 @@
 # If you create a new release for your extension ,
 # remember the migration file is like a blockchain, never edit only add!
 
+import json
+
+from lnbits.db import SQLITE
+from loguru import logger
+
 empty_dict: dict[str, str] = {}
 
 
@@ -62,3 +67,144 @@ async def m003_methods(db):
         );
     """
     )
+
+
+def _create_index(db, name: str, table: str, columns: str, unique: bool = False) -> str:
+    # SQLite expects the schema on the index name, Postgres on the table name.
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    if db.type == SQLITE:
+        return f"CREATE {kind} IF NOT EXISTS shipping.{name} ON {table} ({columns})"
+    return f"CREATE {kind} IF NOT EXISTS {name} ON shipping.{table} ({columns})"
+
+
+async def m004_region_assignments(db):
+    """
+    Join table for region assignments, backfilled from regions.regions.
+    """
+
+    await db.execute(
+        """
+        CREATE TABLE shipping.region_assignments (
+            user_id TEXT NOT NULL,
+            region_name TEXT NOT NULL,
+            regions_id TEXT NOT NULL
+        );
+    """
+    )
+    await db.execute(
+        _create_index(db, "region_assignments_user_region", "region_assignments", "user_id, region_name", unique=True)
+    )
+    await db.execute(_create_index(db, "region_assignments_regions_id", "region_assignments", "regions_id"))
+
+    # the oldest rule keeps a region claimed by several, the others are logged
+    claimed: dict[tuple[str, str], str] = {}
+    rows = await db.fetchall("SELECT id, user_id, regions FROM shipping.regions ORDER BY created_at")
+    for row in rows:
+        for region_name in json.loads(row["regions"] or "[]"):
+            key = (row["user_id"], region_name)
+            if key in claimed:
+                if claimed[key] != row["id"]:
+                    logger.warning(
+                        f"Shipping: region '{region_name}' of user {row['user_id']} is assigned to rule "
+                        f"{claimed[key]}, not to rule {row['id']}."
+                    )
+                continue
+            claimed[key] = row["id"]
+            await db.execute(
+                """
+                INSERT INTO shipping.region_assignments (user_id, region_name, regions_id)
+                VALUES (:user_id, :region_name, :regions_id)
+                """,
+                {"user_id": row["user_id"], "region_name": region_name, "regions_id": row["id"]},
+            )
+
+
+async def m005_settings_primary_key_and_user_indexes(db):
+    """
+    Primary key for extension_settings (keeping the newest row per user)
+    and user_id indexes for regions and methods. The (user_id, title) index
+    also serves plain user_id lookups on methods.
+    """
+
+    await db.execute(
+        f"""
+        CREATE TABLE shipping.extension_settings_new (
+            id TEXT PRIMARY KEY,
+            currency TEXT NOT NULL,
+            available_regions TEXT NOT NULL DEFAULT '[]',
+            updated_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    await db.execute(
+        """
+        INSERT INTO shipping.extension_settings_new (id, currency, available_regions, updated_at)
+        SELECT s.id, s.currency, s.available_regions, s.updated_at
+        FROM shipping.extension_settings s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM shipping.extension_settings t
+            WHERE t.id = s.id AND t.updated_at > s.updated_at
+        )
+        ON CONFLICT DO NOTHING
+    """
+    )
+    await db.execute("DROP TABLE shipping.extension_settings")
+    await db.execute("ALTER TABLE shipping.extension_settings_new RENAME TO extension_settings")
+
+    await db.execute(_create_index(db, "regions_user_id", "regions", "user_id"))
+    await db.execute(_create_index(db, "methods_user_id_title", "methods", "user_id, title"))
+
+
+async def m006_weight_bands(db):
+    """
+    Weight bands for pricing rules.
+    """
+
+    await db.execute(
+        """
+        CREATE TABLE shipping.weight_bands (
+            regions_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            max_weight INT,
+            price REAL NOT NULL,
+            price_per_g REAL
+        );
+    """
+    )
+    await db.execute(_create_index(db, "weight_bands_regions_id", "weight_bands", "regions_id"))
+    await db.execute(_create_index(db, "weight_bands_user_id", "weight_bands", "user_id"))
+
+
+async def m007_cursor_pagination_indexes(db):
+    """
+    Indexes for keyset pagination on the default (created_at, id) order.
+    """
+
+    await db.execute(_create_index(db, "regions_user_id_created_at", "regions", "user_id, created_at, id"))
+    await db.execute(_create_index(db, "methods_user_id_created_at", "methods", "user_id, created_at, id"))
+
+
+async def m008_shipments(db):
+    """
+    Shipment ledger, one row per paid shipping invoice.
+    """
+
+    await db.execute(
+        f"""
+        CREATE TABLE shipping.shipments (
+            payment_hash TEXT PRIMARY KEY,
+            wallet_id TEXT NOT NULL,
+            user_id TEXT,
+            regions_id TEXT,
+            region TEXT,
+            method_id TEXT,
+            weight INT,
+            price REAL,
+            currency TEXT,
+            amount_msat {db.big_int} NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    await db.execute(_create_index(db, "shipments_user_id", "shipments", "user_id"))
+
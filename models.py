@@ -1,7 +1,8 @@
 from datetime import datetime, timezone
+from typing import Generic, TypeVar
 
 from lnbits.db import FilterModel
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
 
 DEFAULT_AVAILABLE_REGIONS = [
     "Africa",
@@ -17,14 +18,56 @@ DEFAULT_AVAILABLE_REGIONS = [
     "Antarctica",
 ]
 
+T = TypeVar("T")
+
+
+class CursorPage(BaseModel, Generic[T]):
+    """
+    A page of a keyset paginated list. `total` is only counted on request.
+    """
+
+    data: list[T]
+    total: int | None = None
+    next_cursor: str | None = None
+
 
 ########################### Regions ############################
+class WeightBand(BaseModel):
+    """
+    Prices weights up to and including `max_weight` grams (no limit if None),
+    starting where the previous band ends. `price_per_g` is charged per gram
+    above the start of the band.
+    """
+
+    max_weight: int | None
+    price: float
+    price_per_g: float | None = None
+
+
+def sort_weight_bands(bands: list[WeightBand]) -> list[WeightBand]:
+    return sorted(bands, key=lambda band: (band.max_weight is None, band.max_weight or 0))
+
+
 class CreateRegions(BaseModel):
     name: str
     regions: list[str]
     price: float
     weight_threshold: int | None
     price_per_g: float | None
+    weight_bands: list[WeightBand] = Field(default_factory=list)
+
+    @validator("weight_bands")
+    def validate_weight_bands(cls, bands: list[WeightBand]) -> list[WeightBand]:
+        bands = sort_weight_bands(bands)
+        limits = [band.max_weight for band in bands]
+        if limits.count(None) > 1:
+            raise ValueError("Only one weight band can be open ended.")
+        closed = [limit for limit in limits if limit is not None]
+        if len(set(closed)) != len(closed):
+            raise ValueError("Weight bands must have distinct max weights.")
+        if any(limit < 0 for limit in closed):
+            raise ValueError("Weight band max weight must be zero or greater.")
+        return bands
 
 
 class Regions(BaseModel):
@@ -35,6 +78,7 @@ class Regions(BaseModel):
     price: float
     weight_threshold: int | None
     price_per_g: float | None
+    weight_bands: list[WeightBand] = Field(default_factory=list, no_database=True)
 
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -58,6 +102,13 @@ class RegionsFilters(FilterModel):
         "created_at",
         "updated_at",
     ]
+    # keyset pagination needs sort columns that are never NULL
+    __cursor_sort_fields__ = [
+        "name",
+        "price",
+        "created_at",
+        "updated_at",
+    ]
 
     created_at: datetime | None
     updated_at: datetime | None
@@ -94,11 +145,33 @@ class MethodFilters(FilterModel):
         "created_at",
         "updated_at",
     ]
+    __cursor_sort_fields__ = [
+        "title",
+        "cost_percentage",
+        "created_at",
+        "updated_at",
+    ]
 
     created_at: datetime | None
     updated_at: datetime | None
 
 
+class ImportMethod(CreateMethod):
+    """
+    `regions` may name pricing rules of the same import or hold existing rule ids.
+    """
+
+
+class BulkImportRequest(BaseModel):
+    regions: list[CreateRegions] = Field(default_factory=list)
+    methods: list[ImportMethod] = Field(default_factory=list)
+
+
+class BulkImportResponse(BaseModel):
+    regions_created: int
+    methods_created: int
+
+
 class AvailableRegionsResponse(BaseModel):
     available_regions: list[str]
     methods: list[Method]
@@ -109,6 +182,12 @@ class CalculatePriceRequest(BaseModel):
     region: str
     weight: int
     method: str | None = None
+    include_token: bool = False
+
+
+class ShippingRatesRequest(BaseModel):
+    region: str
+    weight: int
 
 
 class CalculatePriceResponse(BaseModel):
@@ -125,6 +204,89 @@ class CalculatePriceResponse(BaseModel):
     fiat_price: float
     method_id: str | None
     method_title: str | None
+    # None until the exchange rate of `currency` is cached
+    amount_sat: int | None = None
+    # signed with `include_token`, see `quote_token.verify_quote_token`
+    quote_token: str | None = None
+
+
+class VerifyQuoteToken(BaseModel):
+    token: str
+
+
+class QuoteTokenClaims(BaseModel):
+    user_id: str
+    region: str
+    weight: int
+    regions_id: str
+    method_id: str | None
+    final_price: float
+    currency: str
+    version: int
+    expires_at: int
+
+
+class CreateShippingInvoice(CalculatePriceRequest):
+    memo: str | None = Field(None, max_length=640)
+
+
+class ShippingInvoice(BaseModel):
+    payment_hash: str
+    payment_request: str
+    amount_sat: int
+    quote: CalculatePriceResponse
+
+
+class RateCardRow(BaseModel):
+    region: str
+    regions_id: str
+    method_id: str | None
+    method_title: str | None
+    prices: list[float | None]
+
+
+class RateCard(BaseModel):
+    currency: str
+    weights: list[int]
+    rows: list[RateCardRow]
+
+
+class CalculatePriceBatchItem(BaseModel):
+    result: CalculatePriceResponse | None = None
+    error: str | None = None
+
+
+############################ Shipments ############################
+class Shipment(BaseModel):
+    """
+    A paid shipping invoice with the quote it was created from.
+    """
+
+    payment_hash: str
+    wallet_id: str
+    user_id: str | None = None
+    regions_id: str | None = None
+    region: str | None = None
+    method_id: str | None = None
+    weight: int | None = None
+    price: float | None = None
+    currency: str | None = None
+    amount_msat: int
+
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+######################### Invoice workers #########################
+class InvoiceWorkerStats(BaseModel):
+    workers: int
+    queue_size: int
+    queue_maxsize: int
+    in_flight: int
+    processed: int
+    duplicates: int
+    failed: int
+    avg_latency_ms: float
+    max_latency_ms: float
 
 
 ############################ Settings #############################
@@ -141,3 +303,66 @@ class ExtensionSettings(BaseModel):
 
 class UserExtensionSettings(ExtensionSettings):
     id: str
+
+
+############################ Pricing #############################
+class CacheStats(BaseModel):
+    size: int
+    maxsize: int
+    ttl: float
+    hits: int
+    misses: int
+
+
+class UserConfig(BaseModel):
+    """
+    A user's stored settings (None if never saved), regions and methods,
+    loaded together by `crud.get_user_config`.
+    """
+
+    settings: ExtensionSettings | None
+    regions: list[Regions]
+    methods: list[Method]
+
+    class Config:
+        allow_mutation = False
+
+
+class CompiledWeightBand(BaseModel):
+    start: int
+    price: int
+    price_per_g: int | None
+
+
+class CompiledRegion(BaseModel):
+    """
+    A pricing rule with its amounts as integer price units (see pricing.py).
+    `band_limits` holds the sorted max weights of the closed bands, for bisect.
+    """
+
+    region: Regions
+    price: int
+    bands: list[CompiledWeightBand]
+    band_limits: list[int]
+
+
+class PricingSnapshot(BaseModel):
+    """
+    Immutable, compiled view of a user's settings, regions and methods.
+    Quotes are answered from this snapshot without touching the database.
+    """
+
+    user_id: str
+    version: int
+    currency: str
+    decimals: int
+    available_regions: list[str]
+    regions: list[Regions]
+    region_index: dict[str, CompiledRegion]
+    methods: list[Method]
+    methods_by_id: dict[str, Method]
+    methods_by_title: dict[str, Method]
+    method_percentages: dict[str, int]
+
+    class Config:
+        allow_mutation = False
@@ -0,0 +1,161 @@
+# Description: Integer pricing core used by the quote paths.
+# Amounts are integers of minor currency units scaled by PRICE_SCALE,
+# so per-gram rates smaller than one minor unit stay exact.
+
+from bisect import bisect_left
+from decimal import ROUND_HALF_UP, Decimal
+
+from .models import CompiledRegion, CompiledWeightBand, Regions, WeightBand, sort_weight_bands
+
+PRICE_SCALE = 10**6
+PERCENT_SCALE = 10**6
+ZERO_DECIMAL_CURRENCIES = {"sat", "yen", "jpy"}
+
+
+def currency_decimals(currency: str) -> int:
+    return 0 if currency.lower() in ZERO_DECIMAL_CURRENCIES else 2
+
+
+def div_half_up(numerator: int, denominator: int) -> int:
+    """
+    Integer division rounding half away from zero, like ROUND_HALF_UP.
+    """
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if remainder * 2 >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def to_units(value: float, decimals: int) -> int:
+    """
+    Convert a stored amount to price units. Only used when compiling a snapshot.
+    """
+    units = Decimal(str(value)).scaleb(decimals) * PRICE_SCALE
+    return int(units.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_percentage_units(value: float) -> int:
+    units = Decimal(str(value)) * PERCENT_SCALE
+    return int(units.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _threshold_bands(region: Regions) -> list[WeightBand]:
+    """
+    A single `weight_threshold` rule as bands: flat up to the threshold,
+    then `price_per_g` for every gram above it.
+    """
+    if region.weight_threshold is None or region.price_per_g is None:
+        return [WeightBand(max_weight=None, price=region.price)]
+    return [
+        WeightBand(max_weight=region.weight_threshold, price=region.price),
+        WeightBand(max_weight=None, price=region.price, price_per_g=region.price_per_g),
+    ]
+
+
+def compile_region(region: Regions, decimals: int) -> CompiledRegion:
+    bands = sort_weight_bands(region.weight_bands) or _threshold_bands(region)
+    compiled_bands = []
+    start = 0
+    for band in bands:
+        compiled_bands.append(
+            CompiledWeightBand(
+                start=start,
+                price=to_units(band.price, decimals),
+                price_per_g=to_units(band.price_per_g, decimals) if band.price_per_g is not None else None,
+            )
+        )
+        start = band.max_weight or 0
+    return CompiledRegion(
+        region=region,
+        price=to_units(region.price, decimals),
+        bands=compiled_bands,
+        band_limits=[band.max_weight for band in bands if band.max_weight is not None],
+    )
+
+
+def find_band(rule: CompiledRegion, weight: int) -> CompiledWeightBand:
+    index = bisect_left(rule.band_limits, weight)
+    if index < len(rule.bands):
+        return rule.bands[index]
+    raise ValueError("Weight exceeds the heaviest weight band.")
+
+
+def price_weight_key(rule: CompiledRegion, weight: int) -> tuple[int, int]:
+    """
+    Weights with the same key have the same base price: every weight of a
+    flat band shares the band's key, per-gram bands key on the exact weight.
+    """
+    index = bisect_left(rule.band_limits, weight)
+    if index >= len(rule.bands):
+        raise ValueError("Weight exceeds the heaviest weight band.")
+    return (index, 0) if rule.bands[index].price_per_g is None else (index, weight)
+
+
+def base_price_units(rule: CompiledRegion, weight: int) -> int:
+    band = find_band(rule, weight)
+    if band.price_per_g is None:
+        return band.price
+    return band.price + (weight - band.start) * band.price_per_g
+
+
+def base_price_grid(rule: CompiledRegion, weights: list[int]) -> list[int | None]:
+    """
+    Base prices for ascending `weights` in one merge pass over the bands.
+    None marks weights above the heaviest band.
+    """
+    prices: list[int | None] = []
+    limits = rule.band_limits
+    index = 0
+    for weight in weights:
+        while index < len(limits) and limits[index] < weight:
+            index += 1
+        if index >= len(rule.bands):
+            prices.append(None)
+            continue
+        band = rule.bands[index]
+        if band.price_per_g is None:
+            prices.append(band.price)
+        else:
+            prices.append(band.price + (weight - band.start) * band.price_per_g)
+    return prices
+
+
+def method_fee_units(base_price: int, percentage: int) -> int:
+    return div_half_up(base_price * percentage, 100 * PERCENT_SCALE)
+
+
+def to_amount(units: int, decimals: int) -> float:
+    """
+    Round price units to the currency's minor unit and return the amount.
+    """
+    return div_half_up(units, PRICE_SCALE) / 10**decimals
+
+
+def to_sat(amount: float, rate: float) -> int:
+    """
+    Sats for `amount` at `rate` sats per unit, rounded half up. Decimal, so
+    1.15 at 1400 is 1610 and not the 1609 of `int(1.15 * 1400)`.
+    """
+    sats = Decimal(str(amount)) * Decimal(str(rate))
+    return int(sats.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def final_amount_grid(base_prices: list[int | None], percentage: int, decimals: int) -> list[float | None]:
+    """
+    `to_amount(base + method_fee_units(base, percentage))` over a whole grid,
+    with the half-up divisions inlined for non-negative prices.
+    """
+    fee_denominator = 100 * PERCENT_SCALE
+    half_fee = fee_denominator // 2
+    half_unit = PRICE_SCALE // 2
+    minor_scale = 10**decimals
+    amounts: list[float | None] = []
+    for base in base_prices:
+        if base is None:
+            amounts.append(None)
+        elif base < 0 or percentage < 0:
+            amounts.append(to_amount(base + method_fee_units(base, percentage), decimals))
+        else:
+            final = base + (base * percentage + half_fee) // fee_denominator
+            amounts.append(((final + half_unit) // PRICE_SCALE) / minor_scale)
+    return amounts
@@ -0,0 +1,104 @@
+# Description: HMAC-signed quote tokens, checked without repricing the quote.
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from functools import lru_cache
+
+from lnbits.settings import settings
+
+from .cache import CONFIG_EPOCH, config_version
+from .models import QuoteTokenClaims
+
+QUOTE_TOKEN_TTL = int(os.getenv("SHIPPING_QUOTE_TOKEN_TTL", "900"))
+
+
+@lru_cache(maxsize=1)
+def _signing_key(secret: str) -> bytes:
+    # a key of its own, so a quote token can never pass for another lnbits token
+    return hmac.new(secret.encode(), b"shipping-quote-token", hashlib.sha256).digest()
+
+
+def _sign(payload: bytes) -> bytes:
+    return hmac.new(_signing_key(settings.auth_secret_key), payload, hashlib.sha256).digest()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def create_quote_token(user_id: str, version: int, quote: dict, ttl: int = QUOTE_TOKEN_TTL) -> str:
+    """
+    Sign the price of `quote`, computed from config `version` of `user_id`.
+    """
+    payload = json.dumps(
+        [
+            CONFIG_EPOCH,
+            user_id,
+            quote["region"],
+            quote["weight"],
+            quote["regions_id"],
+            quote["method_id"],
+            quote["final_price"],
+            quote["currency"],
+            version,
+            int(time.time()) + ttl,
+        ],
+        separators=(",", ":"),
+    ).encode()
+    return f"{_b64encode(payload)}.{_b64encode(_sign(payload))}"
+
+
+def verify_quote_token(token: str, user_id: str | None = None, current: bool = True) -> QuoteTokenClaims:
+    """
+    Check the signature, the expiry and that the user's configuration has not
+    changed since the quote was made. Only reads memory.
+    With `current` false only the signature and user are checked, for quotes
+    that were valid when an invoice was created from them.
+    Raises ValueError if the token is not valid, for `user_id` if given.
+    """
+    try:
+        encoded_payload, encoded_signature = token.split(".")
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except ValueError as exc:
+        raise ValueError("Malformed quote token.") from exc
+    if not hmac.compare_digest(signature, _sign(payload)):
+        raise ValueError("Invalid quote token signature.")
+    (
+        epoch,
+        token_user_id,
+        region,
+        weight,
+        regions_id,
+        method_id,
+        final_price,
+        currency,
+        version,
+        expires_at,
+    ) = json.loads(payload)
+    if user_id is not None and token_user_id != user_id:
+        raise ValueError("Quote token belongs to another user.")
+    if current and expires_at < time.time():
+        raise ValueError("Quote token expired.")
+    if current and (epoch != CONFIG_EPOCH or version != config_version(token_user_id)):
+        raise ValueError("Shipping configuration changed since the quote was made.")
+    # the signature vouches for the payload, it does not need validating again
+    return QuoteTokenClaims.construct(
+        user_id=token_user_id,
+        region=region,
+        weight=weight,
+        regions_id=regions_id,
+        method_id=method_id,
+        final_price=final_price,
+        currency=currency,
+        version=version,
+        expires_at=expires_at,
+    )
@@ -1,116 +1,222 @@
-from decimal import ROUND_HALF_UP, Decimal
+import csv
+import io
+import json
+from collections.abc import AsyncIterator
 
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from lnbits.core.crud import get_wallet
 from lnbits.core.models import Payment
+from lnbits.core.services import create_invoice
+from lnbits.helpers import urlsafe_short_hash
 from loguru import logger
+from pydantic import BaseModel
+from sqlalchemy.exc import IntegrityError
 
+from .cache import config_version, pricing_cache, quote_cache, rate_cache, snapshot_loads
 from .crud import (
-    create_extension_settings,  #
+    create_regions_and_methods,
     get_extension_settings,  #
-    get_method_by_id,
-    get_method_by_title,
-    get_methods_by_user,
-    get_regions_by_user,
-    update_extension_settings,  #
+    get_region_assignments,
+    get_regions_ids_by_user,
+    get_user_config,
+    stream_methods_by_user,
+    stream_regions_by_user,
+    upsert_extension_settings,  #
 )
-from .models import ExtensionSettings, Method, Regions  #
+from .instrumentation import phase
+from .models import (
+    BulkImportRequest,
+    BulkImportResponse,
+    CalculatePriceBatchItem,
+    CalculatePriceRequest,
+    CalculatePriceResponse,
+    CompiledRegion,
+    CreateRegions,
+    CreateShippingInvoice,
+    ExtensionSettings,  #
+    ImportMethod,
+    Method,
+    PricingSnapshot,
+    RateCard,
+    RateCardRow,
+    Regions,
+    Shipment,
+    ShippingInvoice,
+    UserConfig,
+)
+from .pricing import (
+    base_price_grid,
+    base_price_units,
+    compile_region,
+    currency_decimals,
+    final_amount_grid,
+    method_fee_units,
+    price_weight_key,
+    to_amount,
+    to_percentage_units,
+    to_sat,
+)
+from .quote_token import create_quote_token, verify_quote_token
 
 
-async def payment_received_for_ignore(payment: Payment) -> bool:
-    logger.info("Payment receive logic generation is disabled.")
-    return True
+async def shipment_from_payment(payment: Payment) -> Shipment | None:
+    """
+    `payment.extra` is set by whoever created the invoice, so the merchant is
+    the owner of the paid wallet and the quote is read from the token signed by
+    the invoice endpoint. None, and nothing recorded, if the token is missing,
+    forged or issued to another user.
+    """
+    wallet = await get_wallet(payment.wallet_id)
+    if not wallet:
+        logger.warning(f"Not recording shipment {payment.payment_hash}: wallet not found.")
+        return None
+    try:
+        claims = verify_quote_token(payment.extra.get("quote_token") or "", wallet.user, current=False)
+    except ValueError as exc:
+        logger.warning(f"Not recording shipment {payment.payment_hash}: {exc}")
+        return None
+    return Shipment(
+        payment_hash=payment.payment_hash,
+        wallet_id=payment.wallet_id,
+        user_id=wallet.user,
+        regions_id=claims.regions_id,
+        region=claims.region,
+        method_id=claims.method_id,
+        weight=claims.weight,
+        price=claims.final_price,
+        currency=claims.currency,
+        amount_msat=payment.amount,
+    )
 
 
 async def get_settings(user_id: str) -> ExtensionSettings:
-    settings = await get_extension_settings(user_id)
+    """
+    Read-only: missing settings and empty regions fall back to defaults in memory.
+    Settings are only persisted by `update_settings`.
+    """
+    return _settings_with_defaults(await get_extension_settings(user_id))
+
+
+def _settings_with_defaults(settings: ExtensionSettings | None) -> ExtensionSettings:
     if not settings:
-        settings = await create_extension_settings(user_id, ExtensionSettings())
-    elif not settings.available_regions:
-        settings.available_regions = ExtensionSettings().available_regions
-        settings = await update_extension_settings(user_id, settings)
+        return ExtensionSettings()
+    if not settings.available_regions:
+        settings = settings.copy(update={"available_regions": ExtensionSettings().available_regions})
     return settings
 
 
 async def update_settings(user_id: str, data: ExtensionSettings) -> ExtensionSettings:
-    settings = await get_extension_settings(user_id)
-    if not settings:
-        settings = await create_extension_settings(user_id, data)
-    else:
-        settings = await update_extension_settings(user_id, data)
+    return await upsert_extension_settings(user_id, data)
 
-    return settings
 
+async def get_pricing_snapshot(user_id: str) -> PricingSnapshot:
+    snapshot = pricing_cache.get(user_id)
+    if snapshot:
+        return snapshot
+    version = config_version(user_id)
+    return await snapshot_loads.do((user_id, version), lambda: _load_pricing_snapshot(user_id, version))
 
-async def get_available_regions_with_methods(user_id: str) -> tuple[list[str], list, list]:
-    settings = await get_settings(user_id)
-    methods = await get_methods_by_user(user_id)
-    regions = await get_regions_by_user(user_id)
-    return settings.available_regions, methods, regions
 
+async def _load_pricing_snapshot(user_id: str, version: int) -> PricingSnapshot:
+    with phase("config_load"):
+        config = await get_user_config(user_id)
+    with phase("compile"):
+        snapshot = _compile_snapshot(user_id, version, config)
+    # a write that happened while loading makes this snapshot stale already
+    if config_version(user_id) == version:
+        pricing_cache.set(user_id, snapshot)
+    return snapshot
 
-def _round_price(value: float, currency: str) -> float:
-    quant = Decimal("1") if currency in {"sat", "yen", "jpy"} else Decimal("0.01")
-    return float(Decimal(str(value)).quantize(quant, rounding=ROUND_HALF_UP))
 
+def _compile_snapshot(user_id: str, version: int, config: UserConfig) -> PricingSnapshot:
+    settings = _settings_with_defaults(config.settings)
+    regions = config.regions
+    methods = config.methods
+    methods_by_title: dict[str, Method] = {}
+    for method in methods:
+        methods_by_title.setdefault(method.title, method)
+    decimals = currency_decimals(settings.currency)
+    return PricingSnapshot(
+        user_id=user_id,
+        version=version,
+        currency=settings.currency,
+        decimals=decimals,
+        available_regions=settings.available_regions,
+        regions=regions,
+        region_index=_build_region_index([compile_region(region, decimals) for region in regions]),
+        methods=methods,
+        methods_by_id={method.id: method for method in methods},
+        methods_by_title=methods_by_title,
+        method_percentages={method.id: to_percentage_units(method.cost_percentage) for method in methods},
+    )
 
-def _get_priced_region(region: str, regions_list: list[Regions]) -> Regions:
-    matching = [item for item in regions_list if region in item.regions]
-    if not matching:
-        raise ValueError("Region not found for any pricing rule.")
-    return sorted(matching, key=lambda item: item.price)[0]
+
+async def get_available_regions_with_methods(user_id: str) -> tuple[list[str], list, list]:
+    snapshot = await get_pricing_snapshot(user_id)
+    return snapshot.available_regions, snapshot.methods, snapshot.regions
 
 
-def _compute_base_price(region_record: Regions, weight: int) -> float:
-    base_price = float(region_record.price)
-    if region_record.weight_threshold is None or region_record.price_per_g is None:
-        return base_price
-    if weight <= region_record.weight_threshold:
-        return base_price
-    return base_price + (weight - region_record.weight_threshold) * float(region_record.price_per_g)
+def _build_region_index(rules: list[CompiledRegion]) -> dict[str, CompiledRegion]:
+    """
+    Map every region name to its cheapest pricing rule.
+    On equal prices the rule listed first wins.
+    """
+    index: dict[str, CompiledRegion] = {}
+    for rule in rules:
+        for name in rule.region.regions:
+            current = index.get(name)
+            if current is None or rule.price < current.price:
+                index[name] = rule
+    return index
 
 
-async def _get_method_for_request(
-    user_id: str,
+def _get_priced_region(region: str, region_index: dict[str, CompiledRegion]) -> CompiledRegion:
+    rule = region_index.get(region)
+    if not rule:
+        raise ValueError("Region not found for any pricing rule.")
+    return rule
+
+
+def _get_method_for_request(
+    snapshot: PricingSnapshot,
     region_id: str,
     method: str | None,
 ) -> Method | None:
     if not method:
         return None
-    method_obj = await get_method_by_id(method)
-    if not method_obj:
-        method_obj = await get_method_by_title(user_id, method)
+    method_obj = snapshot.methods_by_id.get(method) or snapshot.methods_by_title.get(method)
     if not method_obj:
         raise ValueError("Method not found.")
-    if method_obj.user_id != user_id:
-        raise ValueError("Method not found.")
     if method_obj.regions and region_id not in method_obj.regions:
         raise ValueError("Method not available for this region.")
     return method_obj
 
 
-async def calculate_price_for_request(
-    user_id: str,
-    region: str,
-    weight: int,
-    method: str | None,
-) -> dict:
+def _get_base_price(snapshot: PricingSnapshot, region: str, weight: int) -> tuple[Regions, int]:
     if weight < 0:
         raise ValueError("Weight must be zero or greater.")
-    settings = await get_settings(user_id)
-    if region not in settings.available_regions:
+    if region not in snapshot.available_regions:
         raise ValueError("Region is not available.")
-    regions_list = await get_regions_by_user(user_id=user_id)
-    region_record = _get_priced_region(region, regions_list)
-    base_price = _compute_base_price(region_record, weight)
+    rule = _get_priced_region(region, snapshot.region_index)
+    return rule.region, base_price_units(rule, weight)
 
-    method_obj = await _get_method_for_request(user_id, region_record.id, method)
 
+def _price_with_method(
+    snapshot: PricingSnapshot,
+    region: str,
+    weight: int,
+    region_record: Regions,
+    base_price: int,
+    method_obj: Method | None,
+) -> dict:
     cost_percentage = method_obj.cost_percentage if method_obj else 0
-    method_fee = base_price * (cost_percentage / 100)
+    method_fee = method_fee_units(base_price, snapshot.method_percentages[method_obj.id]) if method_obj else 0
     final_price = base_price + method_fee
 
-    rounded_base = _round_price(base_price, settings.currency)
-    rounded_fee = _round_price(method_fee, settings.currency)
-    rounded_final = _round_price(final_price, settings.currency)
+    rounded_base = to_amount(base_price, snapshot.decimals)
+    rounded_fee = to_amount(method_fee, snapshot.decimals)
+    rounded_final = to_amount(final_price, snapshot.decimals)
 
     return {
         "regions_id": region_record.id,
@@ -122,8 +228,377 @@ async def calculate_price_for_request(
         "cost_percentage": cost_percentage,
         "method_fee": rounded_fee,
         "final_price": rounded_final,
-        "currency": settings.currency,
+        "currency": snapshot.currency,
         "fiat_price": rounded_final,
         "method_id": method_obj.id if method_obj else None,
         "method_title": method_obj.title if method_obj else None,
     }
+
+
+def _calculate_price(
+    snapshot: PricingSnapshot,
+    region: str,
+    weight: int,
+    method: str | None,
+) -> dict:
+    with phase("compute"):
+        region_record, base_price = _get_base_price(snapshot, region, weight)
+    with phase("method_lookup"):
+        method_obj = _get_method_for_request(snapshot, region_record.id, method)
+    with phase("compute"):
+        return _price_with_method(snapshot, region, weight, region_record, base_price, method_obj)
+
+
+def _amount_sat(amount: float, currency: str) -> int | None:
+    """
+    Sats from the cached exchange rate, never waits for a rate provider.
+    """
+    if currency.lower() == "sat":
+        return to_sat(amount, 1)
+    rate = rate_cache.get(currency)
+    return to_sat(amount, rate) if rate is not None else None
+
+
+def _with_amount_sat(quote: dict) -> dict:
+    return {**quote, "amount_sat": _amount_sat(quote["final_price"], quote["currency"])}
+
+
+def _quote_cache_key(snapshot: PricingSnapshot, region: str, weight: int, method: str | None) -> tuple | None:
+    """
+    None if the request cannot be priced, the uncached path raises the error.
+    """
+    rule = snapshot.region_index.get(region)
+    if weight < 0 or not rule or region not in snapshot.available_regions:
+        return None
+    try:
+        weight_key = price_weight_key(rule, weight)
+    except ValueError:
+        return None
+    return (snapshot.user_id, snapshot.version, region, weight_key, method)
+
+
+async def calculate_price_for_request(
+    user_id: str,
+    region: str,
+    weight: int,
+    method: str | None,
+    include_token: bool = False,
+) -> dict:
+    snapshot = await get_pricing_snapshot(user_id)
+    key = _quote_cache_key(snapshot, region, weight, method)
+    if key is None:
+        return _calculate_price(snapshot, region, weight, method)
+    quote = quote_cache.get(key)
+    if quote is None:
+        quote = _calculate_price(snapshot, region, weight, method)
+        quote_cache.set(key, quote)
+    # entries are shared by every weight of a flat band and outlive exchange rates
+    quote = _with_amount_sat({**quote, "weight": weight})
+    if include_token:
+        quote["quote_token"] = create_quote_token(user_id, snapshot.version, quote)
+    return quote
+
+
+async def create_shipping_invoice(wallet_id: str, user_id: str, data: CreateShippingInvoice) -> ShippingInvoice:
+    """
+    Reprice the request from the cached snapshot, the client's price is never
+    trusted, and create an invoice whose `extra` carries the signed quote for
+    `shipment_from_payment`. Fiat prices are converted with the cached exchange
+    rate, or by lnbits while that rate is not cached yet.
+    """
+    quote = CalculatePriceResponse(
+        **await calculate_price_for_request(user_id, data.region, data.weight, data.method, include_token=True)
+    )
+    quote_token = quote.quote_token
+    if not data.include_token:
+        quote.quote_token = None
+    if quote.final_price <= 0 or quote.amount_sat == 0:
+        raise ValueError("Nothing to pay for this shipment.")
+    memo = data.memo or f"Shipping to {quote.region}" + (f" ({quote.method_title})" if quote.method_title else "")
+    extra = {
+        "tag": "shipping",
+        "user_id": user_id,
+        "regions_id": quote.regions_id,
+        "region": quote.region,
+        "method_id": quote.method_id,
+        "weight": quote.weight,
+        "final_price": quote.final_price,
+        "currency": quote.currency,
+        "quote_token": quote_token,
+    }
+    amount, currency = quote.final_price, quote.currency
+    if currency.lower() == "sat":
+        currency = "sat"
+    elif quote.amount_sat is not None:
+        extra.update(fiat_currency=currency, fiat_amount=quote.final_price, fiat_rate=quote.amount_sat / amount)
+        amount, currency = quote.amount_sat, "sat"
+    with phase("invoice"):
+        payment = await create_invoice(wallet_id=wallet_id, amount=amount, currency=currency, memo=memo, extra=extra)
+    return ShippingInvoice(
+        payment_hash=payment.payment_hash,
+        payment_request=payment.bolt11,
+        amount_sat=payment.sat,
+        quote=quote,
+    )
+
+
+async def calculate_prices_for_requests(
+    user_id: str,
+    requests: list[CalculatePriceRequest],
+) -> list[CalculatePriceBatchItem]:
+    snapshot = await get_pricing_snapshot(user_id)
+    items = []
+    for request in requests:
+        try:
+            result = _with_amount_sat(_calculate_price(snapshot, request.region, request.weight, request.method))
+            if request.include_token:
+                result["quote_token"] = create_quote_token(user_id, snapshot.version, result)
+            items.append(CalculatePriceBatchItem(result=CalculatePriceResponse(**result)))
+        except ValueError as exc:
+            items.append(CalculatePriceBatchItem(error=str(exc)))
+    return items
+
+
+async def calculate_rates_for_request(
+    user_id: str,
+    region: str,
+    weight: int,
+) -> list[dict]:
+    """
+    Price every method available for the region, cheapest first.
+    """
+    snapshot = await get_pricing_snapshot(user_id)
+    region_record, base_price = _get_base_price(snapshot, region, weight)
+    rates = [
+        _with_amount_sat(_price_with_method(snapshot, region, weight, region_record, base_price, method_obj))
+        for method_obj in snapshot.methods
+        if not method_obj.regions or region_record.id in method_obj.regions
+    ]
+    return sorted(rates, key=lambda rate: rate["final_price"])
+
+
+def _rate_card_row_count(snapshot: PricingSnapshot) -> int:
+    """
+    Rows `_build_rate_card` would produce, without pairing every region with every method.
+    """
+    unrestricted = 0
+    restricted: dict[str, int] = {}
+    for method in snapshot.methods:
+        if not method.regions:
+            unrestricted += 1
+        for regions_id in method.regions:
+            restricted[regions_id] = restricted.get(regions_id, 0) + 1
+    count = 0
+    for region in snapshot.available_regions:
+        rule = snapshot.region_index.get(region)
+        if rule:
+            count += 1 + unrestricted + restricted.get(rule.region.id, 0)
+    return count
+
+
+def _build_rate_card(snapshot: PricingSnapshot, weights: list[int], max_cells: int | None = None) -> RateCard:
+    """
+    Final prices for every region, method and weight. Each pricing rule's base
+    prices are computed once for the whole weight grid and shared by every
+    region and method that uses the rule.
+    """
+    weights = sorted(set(weights))
+    if weights and weights[0] < 0:
+        raise ValueError("Weight must be zero or greater.")
+    if max_cells is not None and _rate_card_row_count(snapshot) * len(weights) > max_cells:
+        raise ValueError(f"Rate card is limited to {max_cells} prices, use fewer weights.")
+    base_grids: dict[str, list[int | None]] = {}
+    final_grids: dict[tuple[str, str | None], list[float | None]] = {}
+    rows = []
+    for region in snapshot.available_regions:
+        rule = snapshot.region_index.get(region)
+        if not rule:
+            continue
+        regions_id = rule.region.id
+        if regions_id not in base_grids:
+            base_grids[regions_id] = base_price_grid(rule, weights)
+        base_grid = base_grids[regions_id]
+        methods: list[Method | None] = [None]
+        methods += [method for method in snapshot.methods if not method.regions or regions_id in method.regions]
+        for method in methods:
+            key = (regions_id, method.id if method else None)
+            if key not in final_grids:
+                percentage = snapshot.method_percentages[method.id] if method else 0
+                final_grids[key] = final_amount_grid(base_grid, percentage, snapshot.decimals)
+            # construct() skips re-validating every cell of an already typed grid
+            rows.append(
+                RateCardRow.construct(
+                    region=region,
+                    regions_id=regions_id,
+                    method_id=method.id if method else None,
+                    method_title=method.title if method else None,
+                    prices=final_grids[key],
+                )
+            )
+    return RateCard.construct(currency=snapshot.currency, weights=weights, rows=rows)
+
+
+async def get_rate_card(user_id: str, weights: list[int], max_cells: int | None = None) -> RateCard:
+    """
+    Built in a worker thread, a large grid would stall the event loop.
+    """
+    snapshot = await get_pricing_snapshot(user_id)
+    return await run_in_threadpool(_build_rate_card, snapshot, weights, max_cells)
+
+
+def rate_card_to_csv(rate_card: RateCard) -> str:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["region", "regions_id", "method_id", "method_title", *rate_card.weights])
+    for row in rate_card.rows:
+        writer.writerow(
+            [
+                row.region,
+                row.regions_id,
+                row.method_id or "",
+                row.method_title or "",
+                *["" if price is None else price for price in row.prices],
+            ]
+        )
+    return output.getvalue()
+
+
+EXPORT_CSV_FIELDS = {
+    "settings": ["currency", "available_regions", "updated_at"],
+    "regions": [
+        "id",
+        "name",
+        "regions",
+        "price",
+        "weight_threshold",
+        "price_per_g",
+        "weight_bands",
+        "created_at",
+        "updated_at",
+    ],
+    "methods": ["id", "title", "cost_percentage", "regions", "created_at", "updated_at"],
+}
+
+
+async def _export_records(user_id: str, table: str) -> AsyncIterator[BaseModel]:
+    if table == "settings":
+        yield await get_settings(user_id)
+    elif table == "regions":
+        async for regions in stream_regions_by_user(user_id):
+            yield regions
+    elif table == "methods":
+        async for method in stream_methods_by_user(user_id):
+            yield method
+
+
+async def export_config_ndjson(user_id: str) -> AsyncIterator[str]:
+    """
+    Stream settings, regions and methods as `{"type": ..., "data": ...}` lines.
+    """
+    for table in EXPORT_CSV_FIELDS:
+        async for record in _export_records(user_id, table):
+            yield f'{{"type": "{table}", "data": {record.json()}}}\n'
+
+
+async def export_config_csv(user_id: str, table: str) -> AsyncIterator[str]:
+    """
+    Stream one table as CSV. Lists and nested records are JSON encoded.
+    """
+    fields = EXPORT_CSV_FIELDS[table]
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(fields)
+    async for record in _export_records(user_id, table):
+        data = jsonable_encoder(record)
+        writer.writerow(
+            [json.dumps(data[field]) if isinstance(data[field], list | dict) else data[field] for field in fields]
+        )
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
+
+
+MAX_IMPORT_ERRORS = 20
+
+
+def parse_import_csv(content: str) -> BulkImportRequest:
+    """
+    Rows have a `type` column of `region` or `method`. `name` is the rule name
+    or method title and `regions` is a `|` separated list.
+    """
+    data = BulkImportRequest()
+    reader = csv.DictReader(io.StringIO(content))
+    for line, row in enumerate(reader, start=2):
+        regions = [item.strip() for item in (row.get("regions") or "").split("|") if item.strip()]
+        try:
+            if row.get("type") == "region":
+                data.regions.append(
+                    CreateRegions.parse_obj(
+                        {
+                            "name": row.get("name"),
+                            "regions": regions,
+                            "price": row.get("price"),
+                            "weight_threshold": row.get("weight_threshold") or None,
+                            "price_per_g": row.get("price_per_g") or None,
+                        }
+                    )
+                )
+            elif row.get("type") == "method":
+                data.methods.append(
+                    ImportMethod.parse_obj(
+                        {
+                            "title": row.get("name"),
+                            "cost_percentage": row.get("cost_percentage") or 0,
+                            "regions": regions,
+                        }
+                    )
+                )
+            else:
+                raise ValueError("type must be 'region' or 'method'")
+        except ValueError as exc:
+            raise ValueError(f"Line {line}: {exc}") from exc
+    return data
+
+
+async def import_config(user_id: str, data: BulkImportRequest) -> BulkImportResponse:
+    """
+    Validate the whole import in one pass and write it in one transaction.
+    Either everything is imported or nothing is.
+    """
+    assigned = await get_region_assignments(user_id)
+    existing_ids = set(await get_regions_ids_by_user(user_id))
+    errors: list[str] = []
+
+    regions_list: list[Regions] = []
+    ids_by_name: dict[str, str | None] = {}
+    for create_regions in data.regions:
+        regions = Regions(**create_regions.dict(), id=urlsafe_short_hash(), user_id=user_id)
+        for name in dict.fromkeys(regions.regions):
+            if name in assigned:
+                errors.append(f"Region '{name}' already assigned.")
+            assigned[name] = regions.id
+        # a name shared by several imported rules cannot be referenced by methods
+        ids_by_name[regions.name] = None if regions.name in ids_by_name else regions.id
+        regions_list.append(regions)
+
+    methods: list[Method] = []
+    for import_method in data.methods:
+        regions_ids = []
+        for ref in import_method.regions:
+            regions_id = ref if ref in existing_ids else ids_by_name.get(ref)
+            if not regions_id:
+                errors.append(f"Method '{import_method.title}': invalid region '{ref}'.")
+                continue
+            regions_ids.append(regions_id)
+        methods.append(
+            Method(**{**import_method.dict(), "regions": regions_ids}, id=urlsafe_short_hash(), user_id=user_id)
+        )
+
+    if errors:
+        raise ValueError(" ".join(errors[:MAX_IMPORT_ERRORS]))
+    try:
+        await create_regions_and_methods(user_id, regions_list, methods)
+    except IntegrityError as exc:
+        raise ValueError("Import conflicts with the current configuration, nothing was imported.") from exc
+    return BulkImportResponse(regions_created=len(regions_list), methods_created=len(methods))
@@ -1,36 +1,264 @@
 import asyncio
+import os
+import time
+from collections.abc import Awaitable, Callable
+from typing import Generic, TypeVar
 
 from lnbits.core.models import Payment
-from lnbits.tasks import register_invoice_listener
+from lnbits.tasks import invoice_listeners, register_invoice_listener
 from loguru import logger
+from sqlalchemy.exc import InterfaceError, OperationalError
 
-from .services import payment_received_for_ignore
+from .cache import RATE_REFRESH_INTERVAL, LRUCache, rate_cache
+from .crud import create_shipments
+from .models import InvoiceWorkerStats, Shipment
+from .services import shipment_from_payment
 
 #######################################
 ########## RUN YOUR TASKS HERE ########
 #######################################
 
+INVOICE_WORKERS = int(os.getenv("SHIPPING_INVOICE_WORKERS", "4"))
+INVOICE_QUEUE_SIZE = int(os.getenv("SHIPPING_INVOICE_QUEUE_SIZE", "1000"))
+INVOICE_DRAIN_TIMEOUT = 10
+PROCESSED_PAYMENTS_MAXSIZE = 10000
+PROCESSED_PAYMENTS_TTL = 24 * 60 * 60
+SHIPMENT_BATCH_SIZE = int(os.getenv("SHIPPING_SHIPMENT_BATCH_SIZE", "100"))
+SHIPMENT_FLUSH_INTERVAL = int(os.getenv("SHIPPING_SHIPMENT_FLUSH_MS", "500")) / 1000
+SHIPMENT_MAX_BUFFER = int(os.getenv("SHIPPING_SHIPMENT_MAX_BUFFER", "10000"))
+# the database is unreachable, as opposed to rows it refuses
+TRANSIENT_WRITE_ERRORS = (OperationalError, InterfaceError, OSError, asyncio.TimeoutError)
+
+T = TypeVar("T")
+
+
+class BatchWriter(Generic[T]):
+    """
+    Buffers items and writes them with `write` in batches, as soon as
+    `batch_size` items are waiting or every `interval` seconds. `add` waits
+    while `max_buffer` items are buffered and returns a future that is done
+    once the item is written.
+    A batch that fails on a connection error is kept for the next flush. On
+    any other error it is split until the failing items are found, which are
+    dropped and logged so they cannot block the items behind them.
+    """
+
+    def __init__(self, write: Callable[[list[T]], Awaitable[None]], batch_size: int, interval: float, max_buffer: int):
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._buffer: list[tuple[T, asyncio.Future[None]]] = []
+        self._slots = asyncio.Semaphore(max_buffer)
+        self._batch_ready = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    async def add(self, item: T) -> asyncio.Future[None]:
+        await self._slots.acquire()
+        written = asyncio.get_running_loop().create_future()
+        self._buffer.append((item, written))
+        if len(self._buffer) >= self.batch_size:
+            self._batch_ready.set()
+        return written
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            while self._buffer:
+                self._batch_ready.clear()
+                batch = self._buffer[: self.batch_size]
+                try:
+                    await self._write_isolating(batch)
+                except TRANSIENT_WRITE_ERRORS as exc:
+                    # kept for the next flush, the writes are idempotent
+                    logger.error(f"Error writing a batch of {len(batch)}, retrying later: {exc}")
+                    return
+                finally:
+                    self._buffer = [entry for entry in self._buffer if not entry[1].done()]
+
+    async def _write_isolating(self, batch: list[tuple[T, asyncio.Future[None]]]) -> None:
+        try:
+            await self.write([item for item, _ in batch])
+        except TRANSIENT_WRITE_ERRORS:
+            raise
+        except Exception as exc:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                await self._write_isolating(batch[:middle])
+                await self._write_isolating(batch[middle:])
+                return
+            self.dropped += 1
+            logger.error(f"Dropped {batch[0][0]!r}, it cannot be written: {exc}")
+            self._settle(batch, exc)
+            return
+        self._settle(batch, None)
+
+    def _settle(self, batch: list[tuple[T, asyncio.Future[None]]], error: Exception | None) -> None:
+        for _, written in batch:
+            if written.done():
+                continue
+            if error:
+                written.set_exception(error)
+            else:
+                written.set_result(None)
+            self._slots.release()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+
+class InvoiceWorkerPool:
+    """
+    Paid invoices are handled by `workers` concurrent consumers of a bounded
+    queue. A full queue makes the lnbits dispatcher wait on `put` (backpressure).
+    Payments already handled, or being handled, are skipped by payment hash.
+    A handler can return a future for work it left pending, e.g. a buffered
+    write. The payment then only counts as handled once that future is done.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Payment], Awaitable[asyncio.Future[None] | None]],
+        workers: int,
+        queue_size: int,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.queue: asyncio.Queue[Payment] = asyncio.Queue(maxsize=queue_size)
+        self._tasks: list[asyncio.Task] = []
+        self._in_flight: set[str] = set()
+        self._processed_hashes: LRUCache[str, bool] = LRUCache(
+            maxsize=PROCESSED_PAYMENTS_MAXSIZE, ttl=PROCESSED_PAYMENTS_TTL
+        )
+        self.processed = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def run(self) -> None:
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            self._tasks = []
+
+    async def drain(self, timeout: float = INVOICE_DRAIN_TIMEOUT) -> None:
+        """
+        Stop receiving payments and wait for the queued ones to be handled.
+        """
+        if invoice_listeners.get("ext_shipping") is self.queue:
+            invoice_listeners.pop("ext_shipping")
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shipping stopped with {self.queue.qsize()} paid invoices still queued.")
+
+    async def _work(self) -> None:
+        while True:
+            payment = await self.queue.get()
+            try:
+                await self._process(payment)
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, payment: Payment) -> None:
+        if payment.extra.get("tag") != "shipping":
+            return
+        payment_hash = payment.payment_hash
+        if payment_hash in self._in_flight or self._processed_hashes.get(payment_hash):
+            self.duplicates += 1
+            return
+        self._in_flight.add(payment_hash)
+        start = time.perf_counter()
+        try:
+            pending = await self.handler(payment)
+        except Exception as exc:
+            self._finish(payment_hash, start, exc)
+            return
+        if pending is None:
+            self._finish(payment_hash, start, None)
+            return
+        pending.add_done_callback(
+            lambda done: self._finish(
+                payment_hash, start, asyncio.CancelledError() if done.cancelled() else done.exception()
+            )
+        )
+
+    def _finish(self, payment_hash: str, start: float, error: BaseException | None) -> None:
+        self._in_flight.discard(payment_hash)
+        latency = time.perf_counter() - start
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if error:
+            self.failed += 1
+            logger.error(f"Error handling paid shipping invoice {payment_hash}: {error!r}")
+            return
+        self._processed_hashes.set(payment_hash, True)
+        self.processed += 1
+
+    def stats(self) -> InvoiceWorkerStats:
+        handled = self.processed + self.failed
+        return InvoiceWorkerStats(
+            workers=len(self._tasks),
+            queue_size=self.queue.qsize(),
+            queue_maxsize=self.queue.maxsize,
+            in_flight=len(self._in_flight),
+            processed=self.processed,
+            duplicates=self.duplicates,
+            failed=self.failed,
+            avg_latency_ms=self.latency_total / handled * 1000 if handled else 0.0,
+            max_latency_ms=self.latency_max * 1000,
+        )
+
+
 # The usual task is to listen to invoices related to this extension
 
 
 async def wait_for_paid_invoices():
-    invoice_queue = asyncio.Queue()
-    register_invoice_listener(invoice_queue, "ext_shipping")
-    while True:
-        payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+    register_invoice_listener(invoice_pool.queue, "ext_shipping")
+    await invoice_pool.run()
+
+
+async def write_shipments():
+    await shipment_writer.run()
+
+
+async def refresh_exchange_rates():
+    await rate_cache.run(RATE_REFRESH_INTERVAL)
 
 
 # Do somethhing when an invoice related top this extension is paid
 
 
-async def on_invoice_paid(payment: Payment) -> None:
+async def on_invoice_paid(payment: Payment) -> asyncio.Future[None] | None:
     if payment.extra.get("tag") != "shipping":
-        return
+        return None
 
     logger.info(f"Invoice paid for shipping: {payment.payment_hash}")
 
-    try:
-        await payment_received_for_ignore(payment)
-    except Exception as e:
-        logger.error(f"Error processing payment for shipping: {e}")
+    shipment = await shipment_from_payment(payment)
+    if shipment is None:
+        return None
+    # done once the shipment is in the ledger, see InvoiceWorkerPool
+    return await shipment_writer.add(shipment)
+
+
+shipment_writer: BatchWriter[Shipment] = BatchWriter(
+    create_shipments,
+    batch_size=SHIPMENT_BATCH_SIZE,
+    interval=SHIPMENT_FLUSH_INTERVAL,
+    max_buffer=SHIPMENT_MAX_BUFFER,
+)
+invoice_pool = InvoiceWorkerPool(on_invoice_paid, workers=INVOICE_WORKERS, queue_size=INVOICE_QUEUE_SIZE)
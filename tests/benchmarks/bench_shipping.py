@@ -0,0 +1,134 @@
+# Benchmarks for the pricing and CRUD hot paths, run with `make bench`.
+# Named bench_* so the regular test run does not collect them.
+# pytest-benchmark times synchronous calls, so every benchmark drives the
+# coroutine on its own event loop.
+
+import asyncio
+from collections.abc import Callable, Coroutine
+from typing import Any
+from uuid import uuid4
+
+import pytest
+from lnbits.db import Filters
+from lnbits.helpers import urlsafe_short_hash
+
+from shipping.cache import invalidate_user_config  # type: ignore[import]
+from shipping.crud import (  # type: ignore[import]
+    create_regions_and_methods,
+    get_assigned_region_names,
+    get_regions_cursor_page,
+    get_regions_paginated,
+    upsert_extension_settings,
+)
+from shipping.models import ExtensionSettings, Method, Regions, RegionsFilters  # type: ignore[import]
+from shipping.services import (  # type: ignore[import]
+    calculate_price_for_request,
+    get_available_regions_with_methods,
+    get_pricing_snapshot,
+)
+
+TENANT_SIZES = [10, 1_000, 10_000]
+
+
+@pytest.fixture(scope="module")
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def tenants(run) -> dict[int, str]:
+    return {size: run(_create_tenant(size)) for size in TENANT_SIZES}
+
+
+async def _create_tenant(size: int) -> str:
+    """
+    `size` pricing rules with one zone each, half of them per gram above 500g,
+    and `size` methods, every other one restricted to a single rule.
+    """
+    user_id = uuid4().hex
+    zones = [f"zone-{i}" for i in range(size)]
+    regions_list = [
+        Regions(
+            id=urlsafe_short_hash(),
+            user_id=user_id,
+            name=f"rule {i}",
+            regions=[zone],
+            price=100 + i % 50,
+            weight_threshold=500 if i % 2 else None,
+            price_per_g=0.5 if i % 2 else None,
+        )
+        for i, zone in enumerate(zones)
+    ]
+    methods = [
+        Method(
+            id=urlsafe_short_hash(),
+            user_id=user_id,
+            title=f"method {i}",
+            cost_percentage=i % 20,
+            regions=[regions_list[i].id] if i % 2 else [],
+        )
+        for i in range(size)
+    ]
+    await upsert_extension_settings(user_id, ExtensionSettings(currency="EUR", available_regions=zones))
+    await create_regions_and_methods(user_id, regions_list, methods)
+    return user_id
+
+
+def _bench(benchmark, run: Callable, coro: Callable[[], Coroutine[Any, Any, Any]]) -> Any:
+    return benchmark(lambda: run(coro()))
+
+
+@pytest.mark.parametrize("size", TENANT_SIZES)
+def test_calculate_price_warm(benchmark, run, tenants, size):
+    user_id = tenants[size]
+    zone = f"zone-{size // 2 + 1}"
+    run(get_pricing_snapshot(user_id))
+    result = _bench(benchmark, run, lambda: calculate_price_for_request(user_id, zone, 750, "method 0"))
+    assert result["region"] == zone
+
+
+@pytest.mark.parametrize("size", TENANT_SIZES)
+def test_pricing_snapshot_cold_load(benchmark, run, tenants, size):
+    user_id = tenants[size]
+
+    async def _load():
+        invalidate_user_config(user_id)
+        return await get_pricing_snapshot(user_id)
+
+    snapshot = _bench(benchmark, run, _load)
+    assert len(snapshot.regions) == size
+
+
+@pytest.mark.parametrize("size", TENANT_SIZES)
+def test_get_available_regions_with_methods(benchmark, run, tenants, size):
+    user_id = tenants[size]
+    run(get_pricing_snapshot(user_id))
+    available_regions, _, regions = _bench(benchmark, run, lambda: get_available_regions_with_methods(user_id))
+    assert len(available_regions) == len(regions) == size
+
+
+@pytest.mark.parametrize("size", TENANT_SIZES)
+def test_region_overlap_check(benchmark, run, tenants, size):
+    user_id = tenants[size]
+    names = ["zone-0", f"zone-{size - 1}", "Atlantis"]
+    assigned = _bench(benchmark, run, lambda: get_assigned_region_names(user_id, names))
+    assert sorted(assigned) == ["zone-0", f"zone-{size - 1}"]
+
+
+@pytest.mark.parametrize("size", TENANT_SIZES)
+def test_regions_paginated_last_page(benchmark, run, tenants, size):
+    user_id = tenants[size]
+    filters = Filters(sortby="created_at", limit=50, offset=max(0, size - 50), model=RegionsFilters)
+    page = _bench(benchmark, run, lambda: get_regions_paginated(user_id, filters))
+    assert page.total == size
+
+
+@pytest.mark.parametrize("size", TENANT_SIZES)
+def test_regions_cursor_page(benchmark, run, tenants, size):
+    user_id = tenants[size]
+    filters = Filters(sortby="created_at", limit=50, model=RegionsFilters)
+    cursor = run(get_regions_cursor_page(user_id, filters, "")).next_cursor or ""
+    page = _bench(benchmark, run, lambda: get_regions_cursor_page(user_id, filters, cursor))
+    assert len(page.data) == (min(50, size - 50) if cursor else size)
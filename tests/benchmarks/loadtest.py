@@ -0,0 +1,258 @@
+# In-process load test for the shipping API, run with `make loadtest`.
+# Mounts `shipping_ext` in an ASGI app on a throwaway SQLite database (or the
+# Postgres database given with --database-url), replays a weighted mix of
+# quote, get_regions and admin write traffic at a fixed concurrency and
+# reports latency percentiles and throughput per operation.
+#
+#   python tests/benchmarks/loadtest.py --requests 20000 --concurrency 64 \
+#       --mix quote=80,get_regions=15,write=5 --tenants 10 --tenant-size 1000
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+OPERATIONS = ("quote", "get_regions", "write")
+LOCAL_RATES = {"EUR": 1500.0, "USD": 1400.0}
+
+
+@dataclass
+class Tenant:
+    user_id: str
+    zones: list[str]
+    regions_ids: list[str]
+    method_titles: list[str]
+    etag: str | None = None
+
+
+@dataclass
+class OperationStats:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+    def summary(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": _percentile(latencies, 50) * 1000,
+            "p95_ms": _percentile(latencies, 95) * 1000,
+            "p99_ms": _percentile(latencies, 99) * 1000,
+        }
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def _parse_mix(value: str) -> dict[str, int]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{name}', expected one of {', '.join(OPERATIONS)}.")
+        mix[name] = int(weight)
+    return mix
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000, help="total number of requests")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight")
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix("quote=80,get_regions=15,write=5"))
+    parser.add_argument("--tenants", type=int, default=10, help="number of merchants")
+    parser.add_argument("--tenant-size", type=int, default=100, help="pricing rules and methods per merchant")
+    parser.add_argument("--database-url", help="local Postgres URL, SQLite in a temp folder if omitted")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def _configure_environment(args: argparse.Namespace, data_folder: str) -> None:
+    # lnbits reads its settings on import, so this has to run first
+    os.environ["LNBITS_DATA_FOLDER"] = data_folder
+    if args.database_url:
+        os.environ["LNBITS_DATABASE_URL"] = args.database_url
+    else:
+        # never write into a database the shell happens to point at
+        os.environ.pop("LNBITS_DATABASE_URL", None)
+    # the extension is imported as `shipping`, like in the test suite
+    sys.path.insert(0, str(Path(__file__).absolute().parents[3]))
+
+
+async def _migrate() -> None:
+    from lnbits.core import migrations as core_migrations
+    from lnbits.core.db import db as core_db
+    from lnbits.core.helpers import run_migration
+
+    import shipping.migrations as ext_migrations  # type: ignore[import]
+    from shipping.crud import db  # type: ignore[import]
+
+    async with core_db.connect() as conn:
+        await run_migration(conn, core_migrations, "core")
+    async with db.connect() as conn:
+        await run_migration(conn, ext_migrations, "shipping")
+
+
+async def _create_tenant(index: int, size: int) -> Tenant:
+    from uuid import uuid4
+
+    from lnbits.helpers import urlsafe_short_hash
+
+    from shipping.crud import create_regions_and_methods, upsert_extension_settings  # type: ignore[import]
+    from shipping.models import ExtensionSettings, Method, Regions  # type: ignore[import]
+
+    user_id = uuid4().hex
+    zones = [f"zone-{index}-{i}" for i in range(size)]
+    regions_list = [
+        Regions(
+            id=urlsafe_short_hash(),
+            user_id=user_id,
+            name=f"rule {i}",
+            regions=[zone],
+            price=100 + i % 50,
+            weight_threshold=500 if i % 2 else None,
+            price_per_g=0.5 if i % 2 else None,
+        )
+        for i, zone in enumerate(zones)
+    ]
+    methods = [
+        Method(id=urlsafe_short_hash(), user_id=user_id, title=f"method {i}", cost_percentage=i % 20)
+        for i in range(size)
+    ]
+    await upsert_extension_settings(user_id, ExtensionSettings(currency="EUR", available_regions=zones))
+    await create_regions_and_methods(user_id, regions_list, methods)
+    return Tenant(
+        user_id=user_id,
+        zones=zones,
+        regions_ids=[regions.id for regions in regions_list],
+        method_titles=[method.title for method in methods],
+    )
+
+
+def _create_app():
+    from fastapi import FastAPI, Request
+    from lnbits.core.models.users import AccountId
+    from lnbits.decorators import check_account_id_exists
+
+    from shipping import shipping_ext  # type: ignore[import]
+    from shipping.cache import rate_cache  # type: ignore[import]
+
+    def _account_from_header(request: Request) -> AccountId:
+        return AccountId(id=request.headers["x-loadtest-user"])
+
+    async def _local_rate(currency: str) -> float:
+        # fixed rates, the load test must not hit the exchange rate APIs
+        return LOCAL_RATES[currency]
+
+    rate_cache.provider = _local_rate
+    app = FastAPI()
+    app.include_router(shipping_ext)
+    app.dependency_overrides[check_account_id_exists] = _account_from_header
+    return app
+
+
+async def _request(client, operation: str, tenant: Tenant, rng: random.Random) -> int:
+    headers = {"x-loadtest-user": tenant.user_id}
+    if operation == "quote":
+        body = {
+            "region": rng.choice(tenant.zones),
+            "weight": rng.randint(0, 2000),
+            "method": rng.choice([None, *tenant.method_titles[:5]]),
+        }
+        response = await client.post("/shipping/api/v1/calculate_price", json=body, headers=headers)
+    elif operation == "get_regions":
+        if tenant.etag:
+            headers["if-none-match"] = tenant.etag
+        response = await client.get("/shipping/api/v1/get_regions", headers=headers)
+        tenant.etag = response.headers.get("etag", tenant.etag)
+    else:
+        index = rng.randrange(len(tenant.regions_ids))
+        body = {
+            "name": f"rule {index}",
+            "regions": [tenant.zones[index]],
+            "price": rng.randint(50, 500),
+            "weight_threshold": None,
+            "price_per_g": None,
+        }
+        response = await client.put(f"/shipping/api/v1/regions/{tenant.regions_ids[index]}", json=body, headers=headers)
+    return response.status_code
+
+
+async def run_load(args: argparse.Namespace) -> dict:
+    import httpx
+
+    await _migrate()
+    tenants = [await _create_tenant(index, args.tenant_size) for index in range(args.tenants)]
+    rng = random.Random(args.seed)
+    operations = [name for name in OPERATIONS if args.mix.get(name)]
+    weights = [args.mix[name] for name in operations]
+    plan = [(rng.choices(operations, weights)[0], rng.choice(tenants)) for _ in range(args.requests)]
+    stats = {name: OperationStats() for name in operations}
+    queue = iter(plan)
+
+    async def _worker(client: httpx.AsyncClient, worker_rng: random.Random) -> None:
+        for operation, tenant in queue:
+            start = time.perf_counter()
+            status = await _request(client, operation, tenant, worker_rng)
+            stats[operation].latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                stats[operation].errors += 1
+
+    transport = httpx.ASGITransport(app=_create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(_worker(client, random.Random(args.seed + worker)) for worker in range(args.concurrency))
+        )
+        elapsed = time.perf_counter() - start
+
+    total = OperationStats()
+    for operation_stats in stats.values():
+        total.latencies += operation_stats.latencies
+        total.errors += operation_stats.errors
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed_s": elapsed,
+        "operations": {name: operation_stats.summary(elapsed) for name, operation_stats in stats.items()},
+        "total": total.summary(elapsed),
+    }
+
+
+def _print_report(report: dict) -> None:
+    print(
+        f"{report['requests']} requests, concurrency {report['concurrency']}, "
+        f"{report['elapsed_s']:.2f}s, {report['total']['throughput']:.0f} req/s"
+    )
+    print(f"{'operation':<12} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, summary in [*report["operations"].items(), ("total", report["total"])]:
+        print(
+            f"{name:<12} {summary['requests']:>9} {summary['errors']:>7} {summary['throughput']:>9.0f} "
+            f"{summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} {summary['p99_ms']:>9.2f}"
+        )
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = _parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="shipping-loadtest-") as data_folder:
+        _configure_environment(args, data_folder)
+        report = asyncio.run(run_load(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import os
 
+import pytest
 import pytest_asyncio
 from lnbits.core import migrations as core_migrations  # type: ignore[import]
 from lnbits.core.db import db as core_db
 from lnbits.core.helpers import run_migration
 
 import shipping.migrations as ext_migrations  # type: ignore[import]
+from shipping.cache import rate_cache  # type: ignore[import]
 from shipping.crud import db  # type: ignore[import]
 
 
@@ -20,3 +22,23 @@ async def init_ext():
         os.remove(db.path)
     async with db.connect() as conn:
         await run_migration(conn, ext_migrations, "shipping")
+
+
+LOCAL_RATES = {"EUR": 1500.0, "USD": 1400.0}
+
+
+async def local_rate_provider(currency: str) -> float:
+    if currency not in LOCAL_RATES:
+        raise ValueError(f"No rate for {currency}.")
+    return LOCAL_RATES[currency]
+
+
+@pytest.fixture(autouse=True)
+def local_rates(monkeypatch):
+    """
+    Quotes never reach the exchange rate APIs in tests.
+    """
+    monkeypatch.setattr(rate_cache, "provider", local_rate_provider)
+    rate_cache.clear()
+    yield
+    rate_cache.clear()
@@ -1,19 +1,37 @@
+import asyncio
 from uuid import uuid4
 
 import pytest
+from fastapi.exceptions import HTTPException
+from lnbits.core.models.users import AccountId
+from lnbits.db import Filters
+from sqlalchemy.exc import IntegrityError
 
+from shipping import crud, views_api  # type: ignore[import]
 from shipping.crud import (  # type: ignore[import]
+    create_method,
     create_regions,
     delete_regions,
+    get_assigned_region_names,
+    get_method_by_id,
     get_regions,
     get_regions_by_id,
+    get_regions_by_user,
+    get_regions_cursor_page,
     get_regions_ids_by_user,
     get_regions_paginated,
+    get_user_config,
+    stream_regions_by_user,
     update_regions,
+    upsert_extension_settings,
 )
 from shipping.models import (  # type: ignore[import]
+    CreateMethod,
     CreateRegions,
+    ExtensionSettings,
     Regions,
+    RegionsFilters,
+    WeightBand,
 )
 
 
@@ -43,7 +61,7 @@ async def test_create_and_get_regions():
 
     data = CreateRegions(
         name="name_27Pt9bgojxiTHFcXoXb4dR",
-        regions=["Europe", "Asia"],
+        regions=["Africa", "Oceania"],
         price=100,
         weight_threshold=82,
         price_per_g=88.45226127098425,
@@ -108,3 +126,199 @@ async def test_update_regions():
     assert regions_one.price == regions_updated.price
     assert regions_one.weight_threshold == regions_updated.weight_threshold
     assert regions_one.price_per_g == regions_updated.price_per_g
+
+
+@pytest.mark.asyncio
+async def test_region_assignments():
+    user_id = uuid4().hex
+
+    data = CreateRegions(
+        name="name_27Pt9bgojxiTHFcXoXb4dR",
+        regions=["Europe", "Asia"],
+        price=100,
+        weight_threshold=None,
+        price_per_g=None,
+    )
+    regions_one = await create_regions(user_id, data)
+    assert await get_assigned_region_names(user_id, ["Asia", "Africa"]) == ["Asia"]
+    assert await get_assigned_region_names(user_id, ["Asia"], exclude_regions_id=regions_one.id) == []
+    assert await get_assigned_region_names(uuid4().hex, ["Asia"]) == []
+
+    with pytest.raises(IntegrityError):
+        await create_regions(user_id, data)
+
+    regions_updated = Regions(**{**regions_one.dict(), "regions": ["Africa"]})
+    await update_regions(regions_updated)
+    assert await get_assigned_region_names(user_id, ["Europe", "Asia", "Africa"]) == ["Africa"]
+
+    await delete_regions(user_id, regions_one.id)
+    assert await get_assigned_region_names(user_id, ["Africa"]) == []
+
+
+@pytest.mark.asyncio
+async def test_concurrent_region_assignment_is_rejected(monkeypatch):
+    user_id = uuid4().hex
+    data = CreateRegions(name="Europe", regions=["Europe"], price=100, weight_threshold=None, price_per_g=None)
+    await create_regions(user_id, data)
+
+    async def _not_assigned_yet(*_args, **_kwargs):
+        return []
+
+    # the other request passed the check before this one was committed
+    monkeypatch.setattr(views_api, "get_assigned_region_names", _not_assigned_yet)
+    with pytest.raises(HTTPException) as exc_info:
+        await views_api.api_create_regions(data, AccountId(id=user_id))
+    assert exc_info.value.status_code == 400
+    assert exc_info.value.detail == "Region already assigned."
+
+
+@pytest.mark.asyncio
+async def test_delete_regions_updates_methods():
+    user_id = uuid4().hex
+    europe = await create_regions(
+        user_id, CreateRegions(name="Europe", regions=["Europe"], price=100, weight_threshold=None, price_per_g=None)
+    )
+    asia = await create_regions(
+        user_id, CreateRegions(name="Asia", regions=["Asia"], price=100, weight_threshold=None, price_per_g=None)
+    )
+    both = await create_method(user_id, CreateMethod(title="Both", regions=[europe.id, asia.id]))
+    asia_only = await create_method(user_id, CreateMethod(title="Asia only", regions=[asia.id]))
+
+    with pytest.raises(ValueError, match="Asia only"):
+        await delete_regions(user_id, asia.id)
+    assert await get_regions(user_id, asia.id)
+
+    await delete_regions(user_id, europe.id)
+    method = await get_method_by_id(both.id)
+    assert method and method.regions == [asia.id]
+    method = await get_method_by_id(asia_only.id)
+    assert method and method.regions == [asia.id]
+
+
+@pytest.mark.asyncio
+async def test_regions_weight_bands():
+    user_id = uuid4().hex
+
+    data = CreateRegions(
+        name="name_27Pt9bgojxiTHFcXoXb4dR",
+        regions=["Europe"],
+        price=100,
+        weight_threshold=None,
+        price_per_g=None,
+        weight_bands=[
+            WeightBand(max_weight=None, price=900, price_per_g=0.1),
+            WeightBand(max_weight=500, price=100),
+            WeightBand(max_weight=2000, price=400),
+        ],
+    )
+    assert [band.max_weight for band in data.weight_bands] == [500, 2000, None]
+    regions_one = await create_regions(user_id, data)
+
+    regions_one = await get_regions(user_id, regions_one.id)
+    assert regions_one.weight_bands == data.weight_bands
+    regions_list = await get_regions_by_user(user_id)
+    assert regions_list[0].weight_bands == data.weight_bands
+
+    regions_updated = Regions(**{**regions_one.dict(), "weight_bands": data.weight_bands[:1]})
+    await update_regions(regions_updated)
+    regions_one = await get_regions_by_id(regions_one.id)
+    assert regions_one.weight_bands == data.weight_bands[:1]
+
+    with pytest.raises(ValueError):
+        CreateRegions(
+            **{
+                **data.dict(),
+                "weight_bands": [WeightBand(max_weight=None, price=1), WeightBand(max_weight=None, price=2)],
+            }
+        )
+
+
+@pytest.mark.asyncio
+async def test_regions_cursor_page():
+    user_id = uuid4().hex
+    created = []
+    for i, price in enumerate([5, 3, 5, 1, 5, 2, 4]):
+        created.append(
+            await create_regions(
+                user_id,
+                CreateRegions(
+                    name=f"rule {i}", regions=[f"zone {i}"], price=price, weight_threshold=None, price_per_g=None
+                ),
+            )
+        )
+
+    for sortby, direction in [("created_at", "asc"), ("price", "desc"), ("name", "asc")]:
+        filters = Filters(sortby=sortby, direction=direction, limit=3, model=RegionsFilters)
+        seen, cursor, pages = [], "", 0
+        while True:
+            page = await get_regions_cursor_page(user_id, filters, cursor, include_total=pages == 0)
+            assert page.total == (len(created) if pages == 0 else None)
+            seen += [regions.id for regions in page.data]
+            pages += 1
+            if not page.next_cursor:
+                break
+            cursor = page.next_cursor
+        assert pages == 3
+        expected = sorted(created, key=lambda regions: (getattr(regions, sortby), regions.id))
+        if direction == "desc":
+            expected.reverse()
+        assert seen == [regions.id for regions in expected]
+
+    with pytest.raises(ValueError, match="sort order"):
+        await get_regions_cursor_page(user_id, Filters(sortby="price", model=RegionsFilters), cursor)
+    with pytest.raises(ValueError, match="cannot sort"):
+        await get_regions_cursor_page(user_id, Filters(sortby="weight_threshold", model=RegionsFilters), "")
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        await get_regions_cursor_page(user_id, Filters(model=RegionsFilters), "not a cursor")
+
+
+@pytest.mark.asyncio
+async def test_get_user_config():
+    user_id = uuid4().hex
+    config = await get_user_config(user_id)
+    assert config.settings is None
+    assert config.regions == [] and config.methods == []
+
+    banded = await create_regions(
+        user_id,
+        CreateRegions(
+            name="Banded",
+            regions=["Asia"],
+            price=1,
+            weight_threshold=None,
+            price_per_g=None,
+            weight_bands=[WeightBand(max_weight=100, price=1), WeightBand(max_weight=None, price=2)],
+        ),
+    )
+    flat = await create_regions(
+        user_id, CreateRegions(name="Flat", regions=["Europe"], price=3, weight_threshold=None, price_per_g=None)
+    )
+    await upsert_extension_settings(user_id, ExtensionSettings(currency="EUR"))
+    method = await create_method(user_id, CreateMethod(title="Express", regions=[flat.id]))
+
+    config = await get_user_config(user_id)
+    assert config.settings and config.settings.currency == "EUR"
+    assert [regions.id for regions in config.regions] == [banded.id, flat.id]
+    assert config.regions[0].weight_bands == banded.weight_bands
+    assert config.regions[1].weight_bands == []
+    assert config.methods == [method]
+
+
+@pytest.mark.asyncio
+async def test_stream_regions_does_not_hold_the_database(monkeypatch):
+    user_id = uuid4().hex
+    created = [
+        await create_regions(
+            user_id,
+            CreateRegions(name=f"rule {i}", regions=[f"zone {i}"], price=i, weight_threshold=None, price_per_g=None),
+        )
+        for i in range(5)
+    ]
+    monkeypatch.setattr(crud, "EXPORT_CHUNK_SIZE", 2)
+
+    stream = stream_regions_by_user(user_id)
+    streamed = [await anext(stream)]
+    # a paused export, e.g. a slow client, must not block other queries
+    assert len(await asyncio.wait_for(get_regions_by_user(user_id), 1)) == 5
+    streamed += [regions async for regions in stream]
+    assert [regions.id for regions in streamed] == [regions.id for regions in created]
@@ -0,0 +1,57 @@
+from uuid import uuid4
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from lnbits.core.models.users import AccountId
+from lnbits.decorators import check_account_id_exists
+
+from shipping.crud import create_regions  # type: ignore[import]
+from shipping.instrumentation import (  # type: ignore[import]
+    metrics_json,
+    metrics_prometheus,
+    reset_metrics,
+    set_instrumentation,
+)
+from shipping.models import CreateRegions  # type: ignore[import]
+from shipping.views_api import shipping_api_router  # type: ignore[import]
+
+
+@pytest.mark.asyncio
+async def test_server_timing_and_metrics():
+    user_id = uuid4().hex
+    await create_regions(
+        user_id,
+        CreateRegions(name="Europe", regions=["Europe"], price=100, weight_threshold=None, price_per_g=None),
+    )
+    app = FastAPI()
+    app.include_router(shipping_api_router)
+    app.dependency_overrides[check_account_id_exists] = lambda: AccountId(id=user_id)
+    transport = httpx.ASGITransport(app=app)
+
+    set_instrumentation(True)
+    reset_metrics()
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://shipping") as client:
+            body = {"region": "Europe", "weight": 10}
+            cold = await client.post("/api/v1/calculate_price", json=body)
+            warm = await client.post("/api/v1/calculate_price", json=body)
+    finally:
+        set_instrumentation(False)
+
+    assert cold.status_code == warm.status_code == 200
+    cold_timing = cold.headers["Server-Timing"]
+    for name in ("request", "config_load", "compile", "compute", "method_lookup", "serialize", "total"):
+        assert f"{name};dur=" in cold_timing
+    assert 'desc="0 queries"' not in cold_timing
+    assert "config_load" not in warm.headers["Server-Timing"]
+    assert 'desc="0 queries"' in warm.headers["Server-Timing"]
+
+    endpoints = metrics_json()["endpoints"]
+    assert [(item["method"], item["route"], item["count"]) for item in endpoints] == [
+        ("POST", "/api/v1/calculate_price", 2)
+    ]
+    assert endpoints[0]["buckets"]["+Inf"] == 2
+    assert 'shipping_request_duration_seconds_count{method="POST",route="/api/v1/calculate_price"} 2' in (
+        metrics_prometheus()
+    )
@@ -0,0 +1,71 @@
+import base64
+import json
+from uuid import uuid4
+
+import pytest
+
+from shipping.crud import create_method, create_regions  # type: ignore[import]
+from shipping.models import CalculatePriceRequest, CreateMethod, CreateRegions  # type: ignore[import]
+from shipping.quote_token import create_quote_token, verify_quote_token  # type: ignore[import]
+from shipping.services import calculate_price_for_request, calculate_prices_for_requests  # type: ignore[import]
+
+
+async def _create_tenant(user_id: str) -> str:
+    regions = await create_regions(
+        user_id,
+        CreateRegions(name="Europe", regions=["Europe"], price=1000, weight_threshold=500, price_per_g=2),
+    )
+    method = await create_method(user_id, CreateMethod(title="Express", cost_percentage=10, regions=[regions.id]))
+    return method.id
+
+
+@pytest.mark.asyncio
+async def test_quote_token_round_trip():
+    user_id = uuid4().hex
+    method_id = await _create_tenant(user_id)
+
+    quote = await calculate_price_for_request(user_id, "Europe", 600, "Express")
+    assert "quote_token" not in quote
+    quote = await calculate_price_for_request(user_id, "Europe", 600, "Express", include_token=True)
+    claims = verify_quote_token(quote["quote_token"], user_id)
+    assert (claims.user_id, claims.region, claims.weight, claims.method_id) == (user_id, "Europe", 600, method_id)
+    assert claims.regions_id == quote["regions_id"]
+    assert (claims.final_price, claims.currency) == (1320, "sat")
+
+    [item] = await calculate_prices_for_requests(
+        user_id, [CalculatePriceRequest(region="Europe", weight=100, include_token=True)]
+    )
+    assert item.result and item.result.quote_token
+    assert verify_quote_token(item.result.quote_token).final_price == 1000
+
+    with pytest.raises(ValueError, match="another user"):
+        verify_quote_token(quote["quote_token"], uuid4().hex)
+    with pytest.raises(ValueError, match="expired"):
+        verify_quote_token(create_quote_token(user_id, claims.version, quote, ttl=-1))
+    with pytest.raises(ValueError, match="Malformed"):
+        verify_quote_token("not a token")
+
+
+@pytest.mark.asyncio
+async def test_quote_token_rejects_tampering_and_config_changes():
+    user_id = uuid4().hex
+    await _create_tenant(user_id)
+    quote = await calculate_price_for_request(user_id, "Europe", 600, None, include_token=True)
+    token = quote["quote_token"]
+
+    payload, signature = token.split(".")
+    data = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    data[6] = 1
+    forged = base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode().rstrip("=")
+    with pytest.raises(ValueError, match="signature"):
+        verify_quote_token(f"{forged}.{signature}")
+
+    verify_quote_token(token, user_id)
+    await create_regions(
+        user_id,
+        CreateRegions(name="Asia", regions=["Asia"], price=3000, weight_threshold=None, price_per_g=None),
+    )
+    with pytest.raises(ValueError, match="configuration changed"):
+        verify_quote_token(token, user_id)
+    # an invoice made from the quote is still recorded once the quote is outdated
+    assert verify_quote_token(token, user_id, current=False).final_price == quote["final_price"]
@@ -0,0 +1,609 @@
+import asyncio
+import json
+import random
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+from fastapi.exceptions import HTTPException
+from lnbits.core.models import Payment
+from lnbits.core.models.users import AccountId
+from lnbits.exceptions import InvoiceError, PaymentError
+
+from shipping import services, views_api  # type: ignore[import]
+from shipping.cache import RateCache, config_etag, invalidate_user_config, quote_cache, rate_cache  # type: ignore[import]
+from shipping.crud import (  # type: ignore[import]
+    create_method,
+    create_regions,
+    get_extension_settings,
+    update_regions,
+)
+from shipping.models import (  # type: ignore[import]
+    BulkImportRequest,
+    CalculatePriceRequest,
+    CreateMethod,
+    CreateRegions,
+    CreateShippingInvoice,
+    ExtensionSettings,
+    ImportMethod,
+    Regions,
+    WeightBand,
+)
+from shipping.pricing import compile_region  # type: ignore[import]
+from shipping.services import (  # type: ignore[import]
+    _build_region_index,
+    calculate_price_for_request,
+    calculate_prices_for_requests,
+    calculate_rates_for_request,
+    create_shipping_invoice,
+    export_config_csv,
+    export_config_ndjson,
+    get_available_regions_with_methods,
+    get_pricing_snapshot,
+    get_rate_card,
+    get_settings,
+    import_config,
+    parse_import_csv,
+    rate_card_to_csv,
+    shipment_from_payment,
+    update_settings,
+)
+
+
+async def _create_tenant(user_id: str) -> tuple[Regions, str]:
+    regions = await create_regions(
+        user_id,
+        CreateRegions(
+            name="Europe flat",
+            regions=["Europe", "UK/Ireland"],
+            price=1000,
+            weight_threshold=500,
+            price_per_g=2,
+        ),
+    )
+    method = await create_method(
+        user_id,
+        CreateMethod(title="Express", cost_percentage=10, regions=[regions.id]),
+    )
+    return regions, method.id
+
+
+@pytest.mark.asyncio
+async def test_calculate_price():
+    user_id = uuid4().hex
+    regions, method_id = await _create_tenant(user_id)
+
+    result = await calculate_price_for_request(user_id, "Europe", 600, method_id)
+    assert result["regions_id"] == regions.id
+    assert result["base_price"] == 1200
+    assert result["method_fee"] == 120
+    assert result["final_price"] == 1320
+    assert result["amount_sat"] == 1320
+
+    by_title = await calculate_price_for_request(user_id, "Europe", 100, "Express")
+    assert by_title["final_price"] == 1100
+
+    with pytest.raises(ValueError, match="Method not found"):
+        await calculate_price_for_request(user_id, "Europe", 100, "Pigeon")
+    with pytest.raises(ValueError, match="Region not found"):
+        await calculate_price_for_request(user_id, "Asia", 100, None)
+
+
+@pytest.mark.asyncio
+async def test_pricing_snapshot_is_cached_and_invalidated(monkeypatch):
+    user_id = uuid4().hex
+    regions, _ = await _create_tenant(user_id)
+    snapshot = await get_pricing_snapshot(user_id)
+
+    async def _no_db(*_args, **_kwargs):
+        raise AssertionError("quote should be served from memory")
+
+    monkeypatch.setattr(services, "get_user_config", _no_db)
+    assert await get_pricing_snapshot(user_id) is snapshot
+    result = await calculate_price_for_request(user_id, "Europe", 100, None)
+    assert result["final_price"] == 1000
+    monkeypatch.undo()
+
+    await update_regions(Regions(**{**regions.dict(), "price": 500}))
+    result = await calculate_price_for_request(user_id, "Europe", 100, None)
+    assert result["final_price"] == 500
+
+
+@pytest.mark.asyncio
+async def test_concurrent_snapshot_loads_are_coalesced(monkeypatch):
+    user_id = uuid4().hex
+    await _create_tenant(user_id)
+    invalidate_user_config(user_id)
+
+    loads = 0
+    get_user_config = services.get_user_config
+
+    async def _counting_get_user_config(*args, **kwargs):
+        nonlocal loads
+        loads += 1
+        return await get_user_config(*args, **kwargs)
+
+    monkeypatch.setattr(services, "get_user_config", _counting_get_user_config)
+    results = await asyncio.gather(*(calculate_price_for_request(user_id, "Europe", 100, None) for _ in range(500)))
+    assert loads == 1
+    assert {result["final_price"] for result in results} == {1000}
+
+
+@pytest.mark.asyncio
+async def test_config_etag_changes_on_write():
+    user_id = uuid4().hex
+    etag = config_etag(user_id)
+    assert etag.startswith('W/"') and config_etag(user_id) == etag
+    assert config_etag(user_id, "limit=10") != config_etag(user_id, "limit=20")
+    # another user at the same config version must not get a 304 for this data
+    other_user = uuid4().hex
+    assert config_etag(other_user) != etag
+    assert config_etag(other_user, "get_regions") != config_etag(user_id, "get_regions")
+
+    await _create_tenant(user_id)
+    after_create = config_etag(user_id)
+    assert after_create != etag
+    await update_settings(user_id, ExtensionSettings(currency="EUR"))
+    assert config_etag(user_id) != after_create
+
+
+@pytest.mark.asyncio
+async def test_quote_cache_buckets_flat_weights():
+    user_id = uuid4().hex
+    regions, method_id = await _create_tenant(user_id)
+    await calculate_price_for_request(user_id, "Europe", 100, method_id)
+
+    misses = quote_cache.misses
+    size = len(quote_cache)
+    # every weight up to the threshold shares the first entry
+    for weight in (0, 250, 500):
+        result = await calculate_price_for_request(user_id, "Europe", weight, method_id)
+        assert result["weight"] == weight
+        assert result["final_price"] == 1100
+    assert quote_cache.misses == misses
+    assert len(quote_cache) == size
+
+    # per-gram weights are cached one by one
+    assert (await calculate_price_for_request(user_id, "Europe", 600, method_id))["final_price"] == 1320
+    assert (await calculate_price_for_request(user_id, "Europe", 601, method_id))["final_price"] == 1322
+    assert quote_cache.misses == misses + 2
+    hits = quote_cache.hits
+    assert (await calculate_price_for_request(user_id, "Europe", 600, method_id))["final_price"] == 1320
+    assert quote_cache.hits == hits + 1
+
+    await update_regions(Regions(**{**regions.dict(), "price": 500}))
+    assert (await calculate_price_for_request(user_id, "Europe", 100, method_id))["final_price"] == 550
+    with pytest.raises(ValueError, match="zero or greater"):
+        await calculate_price_for_request(user_id, "Europe", -1, method_id)
+
+
+@pytest.mark.asyncio
+async def test_create_shipping_invoice(monkeypatch):
+    user_id = uuid4().hex
+    regions, method_id = await _create_tenant(user_id)
+    await get_pricing_snapshot(user_id)
+    invoices: list[dict] = []
+
+    async def _create_invoice(**kwargs) -> Payment:
+        invoices.append(kwargs)
+        return Payment(
+            checking_id="hash",
+            payment_hash="hash",
+            wallet_id=kwargs["wallet_id"],
+            amount=1320 * 1000,
+            fee=0,
+            bolt11="lnbc13200n",
+            extra=kwargs["extra"],
+        )
+
+    async def _no_db(*_args, **_kwargs):
+        raise AssertionError("invoices should be priced from the cached snapshot")
+
+    async def _get_wallet(wallet_id: str):
+        return SimpleNamespace(id=wallet_id, user=user_id if wallet_id == "wallet" else uuid4().hex)
+
+    monkeypatch.setattr(services, "create_invoice", _create_invoice)
+    monkeypatch.setattr(services, "get_user_config", _no_db)
+    monkeypatch.setattr(services, "get_wallet", _get_wallet)
+    invoice = await create_shipping_invoice(
+        "wallet", user_id, CreateShippingInvoice(region="Europe", weight=600, method="Express")
+    )
+    assert (invoice.payment_request, invoice.amount_sat) == ("lnbc13200n", 1320)
+    assert invoice.quote.final_price == 1320
+    assert invoices[0]["amount"] == 1320
+    assert invoices[0]["currency"] == "sat"
+    assert invoices[0]["memo"] == "Shipping to Europe (Express)"
+    assert invoice.quote.quote_token is None
+
+    def _paid(wallet_id: str, **extra) -> Payment:
+        return Payment(
+            checking_id="hash",
+            payment_hash="hash",
+            wallet_id=wallet_id,
+            amount=1320 * 1000,
+            fee=0,
+            bolt11="lnbc13200n",
+            extra={**invoices[0]["extra"], **extra},
+        )
+
+    shipment = await shipment_from_payment(_paid("wallet"))
+    assert shipment
+    assert (shipment.user_id, shipment.regions_id, shipment.method_id) == (user_id, regions.id, method_id)
+    assert (shipment.region, shipment.weight, shipment.price) == ("Europe", 600, 1320)
+
+    # the rest of `extra` is not trusted, a shipment needs the signed quote of the wallet's owner
+    shipment = await shipment_from_payment(_paid("wallet", user_id="someone", final_price=1))
+    assert shipment and (shipment.user_id, shipment.price) == (user_id, 1320)
+    assert await shipment_from_payment(_paid("other wallet")) is None
+    assert await shipment_from_payment(_paid("wallet", quote_token=None)) is None
+
+    with pytest.raises(ValueError, match="Region not found"):
+        await create_shipping_invoice("wallet", user_id, CreateShippingInvoice(region="Asia", weight=1))
+    assert len(invoices) == 1
+
+
+@pytest.mark.asyncio
+async def test_create_shipping_invoice_errors(monkeypatch):
+    user_id = uuid4().hex
+    await update_settings(user_id, ExtensionSettings(currency="SAT"))
+    await _create_tenant(user_id)
+    invoices: list[dict] = []
+
+    async def _create_invoice(**kwargs) -> Payment:
+        invoices.append(kwargs)
+        raise InvoiceError("Funding source is down.", status="pending")
+
+    monkeypatch.setattr(services, "create_invoice", _create_invoice)
+    with pytest.raises(InvoiceError):
+        await create_shipping_invoice("wallet", user_id, CreateShippingInvoice(region="Europe", weight=600))
+    assert (invoices[0]["amount"], invoices[0]["currency"]) == (1200, "sat")
+
+    # a fiat price worth less than a sat is not invoiced
+    async def _worthless(_currency: str) -> float:
+        return 0.0001
+
+    await update_settings(user_id, ExtensionSettings(currency="USD"))
+    monkeypatch.setattr(rate_cache, "provider", _worthless)
+    await rate_cache.refresh("USD")
+    with pytest.raises(ValueError, match="Nothing to pay"):
+        await create_shipping_invoice("wallet", user_id, CreateShippingInvoice(region="Europe", weight=600))
+    assert len(invoices) == 1
+
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id="wallet", user=user_id))
+    data = CreateShippingInvoice(region="Europe", weight=600)
+    for error, status in (
+        (InvoiceError("Wallet does not have permission to create invoices.", status="failed"), 400),
+        (InvoiceError("Funding source is down.", status="pending"), 502),
+        (PaymentError("Payment failed.", status="failed"), 502),
+    ):
+
+        async def _failing(*_args, error=error):
+            raise error
+
+        monkeypatch.setattr(views_api, "create_shipping_invoice", _failing)
+        with pytest.raises(HTTPException) as exc_info:
+            await views_api.api_create_invoice(data, key_info)
+        assert (exc_info.value.status_code, exc_info.value.detail) == (status, error.message)
+
+
+@pytest.mark.asyncio
+async def test_calculate_prices_batch():
+    user_id = uuid4().hex
+    _, method_id = await _create_tenant(user_id)
+
+    items = await calculate_prices_for_requests(
+        user_id,
+        [
+            CalculatePriceRequest(region="Europe", weight=600, method=method_id),
+            CalculatePriceRequest(region="Asia", weight=100),
+            CalculatePriceRequest(region="UK/Ireland", weight=100),
+            CalculatePriceRequest(region="Europe", weight=-1),
+        ],
+    )
+    assert len(items) == 4
+    assert items[0].result and items[0].result.final_price == 1320
+    assert items[1].result is None
+    assert items[1].error == "Region not found for any pricing rule."
+    assert items[2].result and items[2].result.region == "UK/Ireland"
+    assert items[3].error == "Weight must be zero or greater."
+
+
+@pytest.mark.asyncio
+async def test_calculate_rates():
+    user_id = uuid4().hex
+    regions, express_id = await _create_tenant(user_id)
+    other = await create_regions(
+        user_id,
+        CreateRegions(name="Asia", regions=["Asia"], price=3000, weight_threshold=None, price_per_g=None),
+    )
+    standard = await create_method(user_id, CreateMethod(title="Standard"))
+    await create_method(user_id, CreateMethod(title="Asia only", regions=[other.id]))
+
+    rates = await calculate_rates_for_request(user_id, "Europe", 600)
+    assert [rate["method_id"] for rate in rates] == [standard.id, express_id]
+    assert [rate["final_price"] for rate in rates] == [1200, 1320]
+    assert all(rate["regions_id"] == regions.id for rate in rates)
+
+
+def test_region_index_matches_linear_scan():
+    rng = random.Random(7)
+    names = [f"zone-{i}" for i in range(40)]
+    rules = [
+        Regions(
+            id=f"rule-{i}",
+            user_id="user",
+            name=f"rule {i}",
+            regions=rng.sample(names, rng.randint(1, 5)),
+            price=rng.randint(1, 20),
+            weight_threshold=None,
+            price_per_g=None,
+        )
+        for i in range(200)
+    ]
+    index = _build_region_index([compile_region(rule, 0) for rule in rules])
+    for name in names:
+        matching = [item for item in rules if name in item.regions]
+        if not matching:
+            assert name not in index
+            continue
+        assert index[name].region.id == sorted(matching, key=lambda item: item.price)[0].id
+
+
+@pytest.mark.asyncio
+async def test_settings_reads_do_not_write():
+    user_id = uuid4().hex
+
+    settings = await get_settings(user_id)
+    assert settings.currency == "sat"
+    assert await get_extension_settings(user_id) is None
+
+    await update_settings(user_id, ExtensionSettings(currency="EUR", available_regions=[]))
+    settings = await get_settings(user_id)
+    assert settings.currency == "EUR"
+    assert settings.available_regions == ExtensionSettings().available_regions
+    stored = await get_extension_settings(user_id)
+    assert stored and stored.available_regions == []
+
+    await update_settings(user_id, ExtensionSettings(currency="USD", available_regions=["Asia"]))
+    settings = await get_settings(user_id)
+    assert settings.currency == "USD"
+    assert settings.available_regions == ["Asia"]
+
+
+@pytest.mark.asyncio
+async def test_fiat_rounding_is_exact():
+    user_id = uuid4().hex
+    await update_settings(user_id, ExtensionSettings(currency="EUR"))
+    regions = await create_regions(
+        user_id,
+        CreateRegions(name="Europe", regions=["Europe"], price=1.15, weight_threshold=100, price_per_g=0.0015),
+    )
+    method = await create_method(user_id, CreateMethod(title="Tracked", cost_percentage=10, regions=[regions.id]))
+
+    result = await calculate_price_for_request(user_id, "Europe", 100, method.id)
+    # float math gives 0.11499999999999999 for the fee and rounds it down
+    assert result["method_fee"] == 0.12
+    assert result["final_price"] == 1.27
+
+    # 1.15 + 3 * 0.0015 = 1.1545 -> 1.15, fee 0.11545 -> 0.12, final 1.26995 -> 1.27
+    result = await calculate_price_for_request(user_id, "Europe", 103, method.id)
+    assert result["base_price"] == 1.15
+    assert result["method_fee"] == 0.12
+    assert result["final_price"] == 1.27
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_serves_stale_rates_while_refreshing():
+    rates = {"EUR": 1500.0}
+    calls = 0
+
+    async def _provider(currency: str) -> float:
+        nonlocal calls
+        calls += 1
+        return rates[currency]
+
+    cache = RateCache(_provider, max_age=0, max_stale=60, retry_after=60)
+    assert cache.get("eur") is None
+    await asyncio.sleep(0.01)
+    assert calls == 1
+    assert cache.get("EUR") == 1500
+
+    # past max_age the old rate is served and the new one fetched in the background
+    rates["EUR"] = 1600
+    assert cache.get("EUR") == 1500
+    await asyncio.sleep(0.01)
+    assert cache.get("EUR") == 1600
+
+    # failed refreshes keep the last rate until it is too stale to use
+    del rates["EUR"]
+    await cache.refresh_all()
+    await asyncio.sleep(0.01)
+    assert cache.get("EUR") == 1600
+    cache.max_stale = 0
+    assert cache.get("EUR") is None
+    await asyncio.sleep(0.01)
+
+    # and the provider is left alone until `retry_after`, however many quotes ask
+    calls = 0
+    for _ in range(200):
+        assert cache.get("EUR") is None
+        await asyncio.sleep(0)
+    assert calls == 0
+    cache.retry_after = 0
+    rates["EUR"] = 1700
+    cache.max_stale = 60
+    await cache.refresh_all()
+    assert cache.get("EUR") == 1700
+
+
+@pytest.mark.asyncio
+async def test_fiat_quotes_include_amount_sat():
+    user_id = uuid4().hex
+    await update_settings(user_id, ExtensionSettings(currency="EUR"))
+    await _create_tenant(user_id)
+
+    result = await calculate_price_for_request(user_id, "Europe", 600, "Express")
+    assert result["final_price"] == 1320
+    assert result["amount_sat"] is None
+
+    await rate_cache.refresh("EUR")
+    result = await calculate_price_for_request(user_id, "Europe", 600, "Express")
+    assert result["amount_sat"] == 1320 * 1500
+    rates = await calculate_rates_for_request(user_id, "Europe", 600)
+    assert [rate["amount_sat"] for rate in rates] == [1320 * 1500]
+
+    # 1.15 * 1400 is 1609.9999999999998 in floats
+    user_id = uuid4().hex
+    await update_settings(user_id, ExtensionSettings(currency="USD"))
+    await create_regions(
+        user_id, CreateRegions(name="Asia", regions=["Asia"], price=1.15, weight_threshold=None, price_per_g=None)
+    )
+    await rate_cache.refresh("USD")
+    result = await calculate_price_for_request(user_id, "Asia", 100, None)
+    assert (result["final_price"], result["amount_sat"]) == (1.15, 1610)
+
+
+@pytest.mark.asyncio
+async def test_weight_bands_pricing():
+    user_id = uuid4().hex
+    await create_regions(
+        user_id,
+        CreateRegions(
+            name="Carrier zones",
+            regions=["Asia"],
+            price=100,
+            weight_threshold=None,
+            price_per_g=None,
+            weight_bands=[
+                WeightBand(max_weight=500, price=100),
+                WeightBand(max_weight=2000, price=300, price_per_g=0.5),
+                WeightBand(max_weight=5000, price=1500),
+            ],
+        ),
+    )
+
+    prices = [
+        (await calculate_price_for_request(user_id, "Asia", weight, None))["final_price"]
+        for weight in (0, 500, 501, 2000, 2001, 5000)
+    ]
+    assert prices == [100, 100, 301, 1050, 1500, 1500]
+    with pytest.raises(ValueError, match="heaviest weight band"):
+        await calculate_price_for_request(user_id, "Asia", 5001, None)
+
+
+@pytest.mark.asyncio
+async def test_rate_card_matches_single_quotes():
+    user_id = uuid4().hex
+    await update_settings(user_id, ExtensionSettings(currency="EUR"))
+    await _create_tenant(user_id)
+    await create_regions(
+        user_id,
+        CreateRegions(
+            name="Asia",
+            regions=["Asia"],
+            price=5,
+            weight_threshold=None,
+            price_per_g=None,
+            weight_bands=[WeightBand(max_weight=1000, price=5, price_per_g=0.0125)],
+        ),
+    )
+    await create_method(user_id, CreateMethod(title="Standard", cost_percentage=2.5))
+
+    weights = list(range(0, 2001, 250))
+    rate_card = await get_rate_card(user_id, weights)
+    assert rate_card.weights == weights
+    assert {row.region for row in rate_card.rows} == {"Europe", "UK/Ireland", "Asia"}
+    for row in rate_card.rows:
+        for weight, price in zip(rate_card.weights, row.prices, strict=True):
+            try:
+                quote = await calculate_price_for_request(user_id, row.region, weight, row.method_id)
+            except ValueError:
+                assert price is None
+                continue
+            assert price == quote["final_price"]
+
+    lines = rate_card_to_csv(rate_card).splitlines()
+    assert lines[0] == "region,regions_id,method_id,method_title," + ",".join(map(str, weights))
+    assert len(lines) == len(rate_card.rows) + 1
+
+    cells = len(rate_card.rows) * len(weights)
+    assert (await get_rate_card(user_id, weights, max_cells=cells)).rows == rate_card.rows
+    with pytest.raises(ValueError, match="limited"):
+        await get_rate_card(user_id, weights, max_cells=cells - 1)
+
+    response = await views_api.api_get_rate_card(2000, 250, 0, "json", AccountId(id=user_id))
+    assert json.loads(response.body)["rows"] == json.loads(rate_card.json())["rows"]
+    with pytest.raises(HTTPException, match="1000 weights"):
+        await views_api.api_get_rate_card(1000, 1, 0, "json", AccountId(id=user_id))
+
+
+@pytest.mark.asyncio
+async def test_export_config():
+    user_id = uuid4().hex
+    regions, method_id = await _create_tenant(user_id)
+    banded = await create_regions(
+        user_id,
+        CreateRegions(
+            name="Asia",
+            regions=["Asia"],
+            price=5,
+            weight_threshold=None,
+            price_per_g=None,
+            weight_bands=[WeightBand(max_weight=None, price=7), WeightBand(max_weight=1000, price=5)],
+        ),
+    )
+
+    lines = [json.loads(line) async for line in export_config_ndjson(user_id)]
+    assert [line["type"] for line in lines] == ["settings", "regions", "regions", "methods"]
+    assert lines[0]["data"]["currency"] == "sat"
+    assert [line["data"]["id"] for line in lines[1:3]] == [regions.id, banded.id]
+    assert lines[1]["data"]["weight_bands"] == []
+    assert [band["max_weight"] for band in lines[2]["data"]["weight_bands"]] == [1000, None]
+    assert lines[3]["data"]["id"] == method_id
+
+    csv_text = "".join([chunk async for chunk in export_config_csv(user_id, "methods")])
+    header, row = csv_text.splitlines()
+    assert header == "id,title,cost_percentage,regions,created_at,updated_at"
+    assert row.startswith(f"{method_id},Express,10.0,")
+
+
+@pytest.mark.asyncio
+async def test_import_config():
+    user_id = uuid4().hex
+    existing, _ = await _create_tenant(user_id)
+
+    data = parse_import_csv(
+        "type,name,regions,price,weight_threshold,price_per_g,cost_percentage\n"
+        "region,Asia,Asia|Oceania,900,,,\n"
+        "region,Americas,North America|South America,1200,1000,0.5,\n"
+        f"method,Air,Asia|{existing.id},,,,15\n"
+        "method,Ground,,,,,\n"
+    )
+    result = await import_config(user_id, data)
+    assert result.regions_created == 2
+    assert result.methods_created == 2
+
+    air = await calculate_price_for_request(user_id, "Oceania", 100, "Air")
+    assert air["final_price"] == 1035
+    assert (await calculate_price_for_request(user_id, "Europe", 100, "Air"))["final_price"] == 1150
+    with pytest.raises(ValueError, match="not available"):
+        await calculate_price_for_request(user_id, "North America", 100, "Air")
+
+    before = await get_available_regions_with_methods(user_id)
+    with pytest.raises(ValueError) as exc:
+        await import_config(
+            user_id,
+            BulkImportRequest(
+                regions=[
+                    CreateRegions(name="Africa", regions=["Africa"], price=1, weight_threshold=None, price_per_g=None),
+                    CreateRegions(name="Dup", regions=["Asia"], price=1, weight_threshold=None, price_per_g=None),
+                ],
+                methods=[ImportMethod(title="Sea", regions=["Nowhere"])],
+            ),
+        )
+    assert "Region 'Asia' already assigned." in str(exc.value)
+    assert "invalid region 'Nowhere'" in str(exc.value)
+    assert await get_available_regions_with_methods(user_id) == before
+
+    with pytest.raises(ValueError, match="Line 2"):
+        parse_import_csv("type,name,regions,price\nregion,Bad,Asia,not-a-number\n")
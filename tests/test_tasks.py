@@ -0,0 +1,214 @@
+import asyncio
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+from lnbits.core.models import Payment
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from shipping import services  # type: ignore[import]
+from shipping.crud import get_shipment, get_shipments_by_user  # type: ignore[import]
+from shipping.quote_token import create_quote_token  # type: ignore[import]
+from shipping.tasks import BatchWriter, InvoiceWorkerPool, on_invoice_paid, shipment_writer  # type: ignore[import]
+
+
+def _payment(payment_hash: str, tag: str = "shipping", **extra) -> Payment:
+    return Payment(
+        checking_id=payment_hash,
+        payment_hash=payment_hash,
+        wallet_id="wallet",
+        amount=1000,
+        fee=0,
+        bolt11="lnbc",
+        extra={"tag": tag, **extra},
+    )
+
+
+@pytest.mark.asyncio
+async def test_invoice_worker_pool():
+    release = asyncio.Event()
+    running = 0
+    max_running = 0
+    handled: list[str] = []
+
+    async def _slow_handler(payment: Payment) -> None:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await release.wait()
+        handled.append(payment.payment_hash)
+        running -= 1
+
+    pool = InvoiceWorkerPool(_slow_handler, workers=3, queue_size=2)
+    runner = asyncio.create_task(pool.run())
+    hashes = [uuid4().hex for _ in range(5)]
+
+    for payment_hash in hashes[:3]:
+        await pool.queue.put(_payment(payment_hash))
+    await asyncio.sleep(0.01)
+    assert max_running == 3
+    assert pool.stats().in_flight == 3
+
+    # all workers are busy, so the bounded queue fills up and `put` has to wait
+    await pool.queue.put(_payment(hashes[0]))
+    await pool.queue.put(_payment(uuid4().hex, tag="other"))
+    assert pool.queue.full()
+    blocked_put = asyncio.create_task(pool.queue.put(_payment(hashes[3])))
+    await asyncio.sleep(0.01)
+    assert not blocked_put.done()
+
+    release.set()
+    await blocked_put
+    await pool.queue.put(_payment(hashes[4]))
+    await pool.drain(timeout=1)
+    assert sorted(handled) == sorted(hashes)
+    assert pool.duplicates == 1
+
+    # redelivery after handling is skipped as well
+    await pool.queue.put(_payment(hashes[1]))
+    await pool.drain(timeout=1)
+    stats = pool.stats()
+    assert stats.processed == 5
+    assert stats.duplicates == 2
+    assert stats.queue_size == 0
+    assert stats.workers == 3
+
+    runner.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await runner
+    assert pool.stats().workers == 0
+
+
+@pytest.mark.asyncio
+async def test_batch_writer():
+    batches: list[list[int]] = []
+
+    async def _write(batch: list[int]) -> None:
+        batches.append(batch)
+
+    writer = BatchWriter(_write, batch_size=3, interval=0.1, max_buffer=100)
+    runner = asyncio.create_task(writer.run())
+    written = await writer.add(0)
+    await writer.add(1)
+    await asyncio.sleep(0.01)
+    assert batches == []
+    assert not written.done()
+    await asyncio.sleep(0.15)
+    assert batches == [[0, 1]]
+    assert written.done()
+
+    # a full batch is written without waiting for the interval
+    for item in range(2, 9):
+        await writer.add(item)
+    await asyncio.sleep(0.01)
+    assert batches == [[0, 1], [2, 3, 4], [5, 6, 7], [8]]
+    assert len(writer) == 0
+    runner.cancel()
+
+
+@pytest.mark.asyncio
+async def test_batch_writer_isolates_failures():
+    written_items: list[int] = []
+    database_down = True
+
+    async def _write(batch: list[int]) -> None:
+        if database_down:
+            raise OperationalError("INSERT", {}, Exception("connection refused"))
+        if 3 in batch:
+            raise IntegrityError("INSERT", {}, Exception("bad row"))
+        written_items.extend(batch)
+
+    writer = BatchWriter(_write, batch_size=4, interval=60, max_buffer=6)
+    futures = [await writer.add(item) for item in range(6)]
+
+    # connection errors keep everything for the next flush
+    await writer.flush()
+    assert len(writer) == 6
+    assert not any(future.done() for future in futures)
+
+    # the buffer is full, adding waits until a flush makes room
+    blocked_add = asyncio.create_task(writer.add(6))
+    await asyncio.sleep(0.01)
+    assert not blocked_add.done()
+
+    # a bad row is dropped without holding back the rest of its batch
+    database_down = False
+    await writer.flush()
+    futures.append(await blocked_add)
+    await writer.flush()
+    assert sorted(written_items) == [0, 1, 2, 4, 5, 6]
+    assert writer.dropped == 1
+    with pytest.raises(IntegrityError):
+        futures[3].result()
+    assert all(future.result() is None for i, future in enumerate(futures) if i != 3)
+    assert len(writer) == 0
+
+
+@pytest.mark.asyncio
+async def test_payments_are_processed_once_written():
+    writes: list[asyncio.Future[None]] = []
+
+    async def _buffered_handler(payment: Payment) -> asyncio.Future[None]:
+        written: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        writes.append(written)
+        return written
+
+    pool = InvoiceWorkerPool(_buffered_handler, workers=1, queue_size=10)
+    runner = asyncio.create_task(pool.run())
+    await asyncio.sleep(0)
+    await pool.queue.put(_payment("written"))
+    await pool.queue.put(_payment("dropped"))
+    await pool.drain(timeout=1)
+    assert pool.stats().in_flight == 2
+    assert pool.processed == 0
+
+    writes[0].set_result(None)
+    writes[1].set_exception(ValueError("bad row"))
+    await asyncio.sleep(0)
+    stats = pool.stats()
+    assert (stats.in_flight, stats.processed, stats.failed) == (0, 1, 1)
+
+    # a payment whose write failed is handled again when it is redelivered
+    await pool.queue.put(_payment("written"))
+    await pool.queue.put(_payment("dropped"))
+    await pool.drain(timeout=1)
+    assert len(writes) == 3
+    assert pool.duplicates == 1
+    runner.cancel()
+
+
+@pytest.mark.asyncio
+async def test_paid_invoices_are_recorded_as_shipments(monkeypatch):
+    user_id = uuid4().hex
+
+    async def _get_wallet(wallet_id: str):
+        return SimpleNamespace(id=wallet_id, user=user_id)
+
+    monkeypatch.setattr(services, "get_wallet", _get_wallet)
+    quote = {
+        "regions_id": "rule",
+        "region": "Europe",
+        "method_id": "express",
+        "weight": 600,
+        "final_price": 13.2,
+        "currency": "EUR",
+    }
+    quote["quote_token"] = create_quote_token(user_id, 0, quote)
+    hashes = [uuid4().hex for _ in range(3)]
+    writes = [await on_invoice_paid(_payment(payment_hash, **quote)) for payment_hash in hashes]
+    assert await on_invoice_paid(_payment(uuid4().hex, tag="other")) is None
+    assert await on_invoice_paid(_payment(uuid4().hex, region="Europe")) is None
+    assert len(shipment_writer) == 3
+    await shipment_writer.flush()
+    assert all(written and written.done() for written in writes)
+
+    # a redelivered payment is written again and ignored by the database
+    await on_invoice_paid(_payment(hashes[0], **quote))
+    await shipment_writer.flush()
+
+    shipments = await get_shipments_by_user(user_id)
+    assert sorted(shipment.payment_hash for shipment in shipments) == sorted(hashes)
+    shipment = await get_shipment(hashes[0])
+    assert shipment
+    assert (shipment.region, shipment.method_id, shipment.weight) == ("Europe", "express", 600)
+    assert (shipment.price, shipment.currency, shipment.amount_msat) == (13.2, "EUR", 1000)
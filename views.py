@@ -6,7 +6,9 @@ from lnbits.core.views.generic import index
 from lnbits.decorators import check_account_exists
 from lnbits.helpers import template_renderer
 
-shipping_generic_router = APIRouter()
+from .instrumentation import InstrumentedRoute
+
+shipping_generic_router = APIRouter(route_class=InstrumentedRoute)
 
 
 def shipping_renderer():
@@ -1,54 +1,113 @@
 # Description: This file contains the extensions API endpoints.
 from http import HTTPStatus
+from typing import Literal
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.exceptions import HTTPException
-from lnbits.core.models import SimpleStatus, User
+from fastapi.responses import JSONResponse, StreamingResponse
+from lnbits.core.models import SimpleStatus, User, WalletTypeInfo
 from lnbits.core.models.users import AccountId
-from lnbits.db import Filters, Page
+from lnbits.db import Filters
 from lnbits.decorators import (
     check_account_exists,
     check_account_id_exists,
+    check_admin,
     parse_filters,
+    require_invoice_key,
 )
+from lnbits.exceptions import InvoiceError, PaymentError
 from lnbits.helpers import generate_filter_params_openapi
+from sqlalchemy.exc import IntegrityError
 
+from .cache import config_etag, pricing_cache, quote_cache
 from .crud import (
     create_method,
     create_regions,
     delete_method,
     delete_regions,
+    get_assigned_region_names,
+    get_existing_regions_ids,
     get_method_by_id,
+    get_methods_cursor_page,
     get_methods_paginated,
     get_regions,
-    get_regions_by_user,
+    get_regions_cursor_page,
     get_regions_paginated,
     update_method,
     update_regions,
 )
+from .instrumentation import InstrumentedRoute, metrics_json, metrics_prometheus
 from .models import (
     AvailableRegionsResponse,
+    BulkImportRequest,
+    BulkImportResponse,
+    CacheStats,
+    CalculatePriceBatchItem,
     CalculatePriceRequest,
     CalculatePriceResponse,
     CreateMethod,
     CreateRegions,
+    CreateShippingInvoice,
+    CursorPage,
     ExtensionSettings,  #
+    InvoiceWorkerStats,
     Method,
     MethodFilters,
+    QuoteTokenClaims,
+    RateCard,
     Regions,
     RegionsFilters,
+    ShippingInvoice,
+    ShippingRatesRequest,
+    VerifyQuoteToken,
 )
+from .quote_token import verify_quote_token
 from .services import (
     calculate_price_for_request,
+    calculate_prices_for_requests,
+    calculate_rates_for_request,
+    create_shipping_invoice,
+    export_config_csv,
+    export_config_ndjson,
     get_available_regions_with_methods,
+    get_rate_card,
     get_settings,  #
+    import_config,
+    parse_import_csv,
+    rate_card_to_csv,
     update_settings,  #
 )
+from .tasks import invoice_pool
 
 regions_filters = parse_filters(RegionsFilters)
 method_filters = parse_filters(MethodFilters)
 
-shipping_api_router = APIRouter()
+shipping_api_router = APIRouter(route_class=InstrumentedRoute)
+
+MAX_BATCH_SIZE = 1000
+MAX_RATE_CARD_WEIGHTS = 1000
+MAX_RATE_CARD_CELLS = 100_000
+MAX_IMPORT_ITEMS = 10000
+
+
+def _not_modified(request: Request, response: Response, etag: str) -> Response | None:
+    """
+    Set the ETag on `response` and return a 304 if the client already has it.
+    Check this before loading anything, a write after the check only makes the tag stale.
+    """
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if "*" in tags or etag.removeprefix("W/") in tags:
+        return Response(
+            status_code=HTTPStatus.NOT_MODIFIED,
+            headers={"ETag": etag, "Cache-Control": "no-cache"},
+        )
+    return None
 
 
 ############################# Regions #############################
@@ -57,11 +116,13 @@ async def api_create_regions(
     data: CreateRegions,
     account_id: AccountId = Depends(check_account_id_exists),
 ) -> Regions:
-    existing = await get_regions_by_user(account_id.id)
-    for row in existing:
-        if set(row.regions) & set(data.regions):
-            raise HTTPException(HTTPStatus.BAD_REQUEST, "Region already assigned.")
-    regions = await create_regions(account_id.id, data)
+    if await get_assigned_region_names(account_id.id, data.regions):
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Region already assigned.")
+    try:
+        regions = await create_regions(account_id.id, data)
+    except IntegrityError as exc:
+        # assigned by a concurrent request since the check
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Region already assigned.") from exc
     return regions
 
 
@@ -76,13 +137,12 @@ async def api_update_regions(
         raise HTTPException(HTTPStatus.NOT_FOUND, "Regions not found.")
     if regions.user_id != account_id.id:
         raise HTTPException(HTTPStatus.FORBIDDEN, "You do not own this regions.")
-    existing = await get_regions_by_user(account_id.id)
-    for row in existing:
-        if row.id == regions_id:
-            continue
-        if set(row.regions) & set(data.regions):
-            raise HTTPException(HTTPStatus.BAD_REQUEST, "Region already assigned.")
-    regions = await update_regions(Regions(**{**regions.dict(), **data.dict()}))
+    if await get_assigned_region_names(account_id.id, data.regions, exclude_regions_id=regions_id):
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Region already assigned.")
+    try:
+        regions = await update_regions(Regions(**{**regions.dict(), **data.dict()}))
+    except IntegrityError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Region already assigned.") from exc
     return regions
 
 
@@ -92,17 +152,29 @@ async def api_update_regions(
     summary="get paginated list of regions",
     response_description="list of regions",
     openapi_extra=generate_filter_params_openapi(RegionsFilters),
-    response_model=Page[Regions],
+    response_model=CursorPage[Regions],
 )
 async def api_get_regions_paginated(
+    request: Request,
+    response: Response,
     account_id: AccountId = Depends(check_account_id_exists),
     filters: Filters = Depends(regions_filters),
-) -> Page[Regions]:
-
-    return await get_regions_paginated(
-        user_id=account_id.id,
-        filters=filters,
-    )
+    cursor: str | None = Query(None, description="Keyset cursor, empty for the first page."),
+    include_total: bool = Query(False),
+) -> CursorPage[Regions] | Response:
+    not_modified = _not_modified(request, response, config_etag(account_id.id, f"regions?{request.url.query}"))
+    if not_modified:
+        return not_modified
+    if cursor is None:
+        page = await get_regions_paginated(
+            user_id=account_id.id,
+            filters=filters,
+        )
+        return CursorPage(data=page.data, total=page.total)
+    try:
+        return await get_regions_cursor_page(account_id.id, filters, cursor, include_total)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
 
 
 @shipping_api_router.get(
@@ -136,7 +208,10 @@ async def api_delete_regions(
     account_id: AccountId = Depends(check_account_id_exists),
 ) -> SimpleStatus:
 
-    await delete_regions(account_id.id, regions_id)
+    try:
+        await delete_regions(account_id.id, regions_id)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
     return SimpleStatus(success=True, message="Regions Deleted")
 
 
@@ -153,10 +228,8 @@ async def api_create_method(
     data: CreateMethod,
     account_id: AccountId = Depends(check_account_id_exists),
 ) -> Method:
-    regions_list = await get_regions_by_user(account_id.id)
-    valid_region_ids = {region.id for region in regions_list}
-    invalid = [region_id for region_id in data.regions if region_id not in valid_region_ids]
-    if invalid:
+    valid_region_ids = await get_existing_regions_ids(account_id.id, data.regions)
+    if any(region_id not in valid_region_ids for region_id in data.regions):
         raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid region.")
     return await create_method(account_id.id, data)
 
@@ -178,10 +251,8 @@ async def api_update_method(
         raise HTTPException(HTTPStatus.NOT_FOUND, "Method not found.")
     if method.user_id != account_id.id:
         raise HTTPException(HTTPStatus.FORBIDDEN, "You do not own this method.")
-    regions_list = await get_regions_by_user(account_id.id)
-    valid_region_ids = {region.id for region in regions_list}
-    invalid = [region_id for region_id in data.regions if region_id not in valid_region_ids]
-    if invalid:
+    valid_region_ids = await get_existing_regions_ids(account_id.id, data.regions)
+    if any(region_id not in valid_region_ids for region_id in data.regions):
         raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid region.")
 
     method = await update_method(Method(**{**method.dict(), **data.dict()}))
@@ -194,16 +265,29 @@ async def api_update_method(
     summary="get paginated list of methods",
     response_description="list of methods",
     openapi_extra=generate_filter_params_openapi(MethodFilters),
-    response_model=Page[Method],
+    response_model=CursorPage[Method],
 )
 async def api_get_methods_paginated(
+    request: Request,
+    response: Response,
     account_id: AccountId = Depends(check_account_id_exists),
     filters: Filters = Depends(method_filters),
-) -> Page[Method]:
-    return await get_methods_paginated(
-        user_id=account_id.id,
-        filters=filters,
-    )
+    cursor: str | None = Query(None, description="Keyset cursor, empty for the first page."),
+    include_total: bool = Query(False),
+) -> CursorPage[Method] | Response:
+    not_modified = _not_modified(request, response, config_etag(account_id.id, f"methods?{request.url.query}"))
+    if not_modified:
+        return not_modified
+    if cursor is None:
+        page = await get_methods_paginated(
+            user_id=account_id.id,
+            filters=filters,
+        )
+        return CursorPage(data=page.data, total=page.total)
+    try:
+        return await get_methods_cursor_page(account_id.id, filters, cursor, include_total)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
 
 
 @shipping_api_router.get(
@@ -255,8 +339,13 @@ async def api_delete_method(
     response_model=AvailableRegionsResponse,
 )
 async def api_get_available_regions(
+    request: Request,
+    response: Response,
     account_id: AccountId = Depends(check_account_id_exists),
-) -> AvailableRegionsResponse:
+) -> AvailableRegionsResponse | Response:
+    not_modified = _not_modified(request, response, config_etag(account_id.id, "get_regions"))
+    if not_modified:
+        return not_modified
     available_regions, methods, regions = await get_available_regions_with_methods(account_id.id)
     return AvailableRegionsResponse(available_regions=available_regions, methods=methods, regions=regions)
 
@@ -278,12 +367,222 @@ async def api_calculate_price(
             data.region,
             data.weight,
             data.method,
+            data.include_token,
         )
     except ValueError as exc:
         raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
     return CalculatePriceResponse(**result)
 
 
+@shipping_api_router.post(
+    "/api/v1/quote_token/verify",
+    name="Verify Quote Token",
+    summary="Check a quote token from calculate_price without pricing the quote again.",
+    response_description="The signed quote, or 400 if the token is invalid, expired or outdated",
+    response_model=QuoteTokenClaims,
+)
+async def api_verify_quote_token(
+    data: VerifyQuoteToken,
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> QuoteTokenClaims:
+    try:
+        return verify_quote_token(data.token, account_id.id)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+
+
+@shipping_api_router.post(
+    "/api/v1/invoice",
+    name="Create Shipping Invoice",
+    summary="Price a region, weight and method and create a Lightning invoice for it.",
+    description="The price is recomputed from the wallet owner's configuration, "
+    "paid invoices are recorded as shipments.",
+    response_description="The invoice and the quote it was created from",
+    response_model=ShippingInvoice,
+    status_code=HTTPStatus.CREATED,
+)
+async def api_create_invoice(
+    data: CreateShippingInvoice,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> ShippingInvoice:
+    try:
+        return await create_shipping_invoice(key_info.wallet.id, key_info.wallet.user, data)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+    except InvoiceError as exc:
+        # "failed" is a request the wallet refuses, "pending" a funding source error
+        status = HTTPStatus.BAD_REQUEST if exc.status == "failed" else HTTPStatus.BAD_GATEWAY
+        raise HTTPException(status, exc.message) from exc
+    except PaymentError as exc:
+        raise HTTPException(HTTPStatus.BAD_GATEWAY, exc.message) from exc
+
+
+@shipping_api_router.post(
+    "/api/v1/calculate_price/batch",
+    name="Calculate Shipping Prices",
+    summary="Calculate shipping prices for many region, weight and method combinations.",
+    response_description="Calculated shipping prices or errors, in request order",
+    response_model=list[CalculatePriceBatchItem],
+)
+async def api_calculate_price_batch(
+    data: list[CalculatePriceRequest],
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> list[CalculatePriceBatchItem]:
+    if len(data) > MAX_BATCH_SIZE:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, f"Batch is limited to {MAX_BATCH_SIZE} items.")
+    return await calculate_prices_for_requests(account_id.id, data)
+
+
+@shipping_api_router.post(
+    "/api/v1/rates",
+    name="Shipping Rates",
+    summary="Price every shipping method available for a region and weight.",
+    response_description="Priced shipping methods, cheapest first",
+    response_model=list[CalculatePriceResponse],
+)
+async def api_get_shipping_rates(
+    data: ShippingRatesRequest,
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> list[CalculatePriceResponse]:
+    try:
+        rates = await calculate_rates_for_request(account_id.id, data.region, data.weight)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+    return [CalculatePriceResponse(**rate) for rate in rates]
+
+
+@shipping_api_router.get(
+    "/api/v1/rate_card",
+    name="Rate Card",
+    summary="Final prices for every region, method and weight step.",
+    response_description="The rate card as JSON, or CSV with one column per weight",
+    response_model=RateCard,
+)
+async def api_get_rate_card(
+    max_weight: int = Query(..., ge=0),
+    step: int = Query(..., gt=0),
+    min_weight: int = Query(0, ge=0),
+    export_format: Literal["json", "csv"] = Query("json", alias="format"),
+    account_id: AccountId = Depends(check_account_id_exists),
+):
+    weights = range(min_weight, max_weight + 1, step)
+    if len(weights) > MAX_RATE_CARD_WEIGHTS:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, f"Rate card is limited to {MAX_RATE_CARD_WEIGHTS} weights.")
+    try:
+        rate_card = await get_rate_card(account_id.id, list(weights), MAX_RATE_CARD_CELLS)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+    # serialized off the event loop as well
+    if export_format == "csv":
+        return Response(
+            content=await run_in_threadpool(rate_card_to_csv, rate_card),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="rate_card.csv"'},
+        )
+    return Response(content=await run_in_threadpool(rate_card.json), media_type="application/json")
+
+
+@shipping_api_router.get(
+    "/api/v1/export",
+    name="Export Configuration",
+    summary="Stream the settings, regions and methods of the current user.",
+    response_description="NDJSON with one record per line, or CSV of one table",
+    response_class=StreamingResponse,
+)
+async def api_export_config(
+    export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    table: Literal["settings", "regions", "methods"] = Query("regions"),
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> StreamingResponse:
+    if export_format == "csv":
+        return StreamingResponse(
+            export_config_csv(account_id.id, table),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="shipping_{table}.csv"'},
+        )
+    return StreamingResponse(
+        export_config_ndjson(account_id.id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="shipping.ndjson"'},
+    )
+
+
+@shipping_api_router.post(
+    "/api/v1/import",
+    name="Import Configuration",
+    summary="Create many regions and methods at once.",
+    response_description="The number of created regions and methods",
+    response_model=BulkImportResponse,
+    status_code=HTTPStatus.CREATED,
+)
+async def api_import_config(
+    data: BulkImportRequest,
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> BulkImportResponse:
+    if len(data.regions) + len(data.methods) > MAX_IMPORT_ITEMS:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, f"Import is limited to {MAX_IMPORT_ITEMS} items.")
+    try:
+        return await import_config(account_id.id, data)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+
+
+@shipping_api_router.post(
+    "/api/v1/import/csv",
+    name="Import Configuration CSV",
+    summary="Create many regions and methods from a CSV body.",
+    description="Columns: type (region or method), name, regions (| separated), "
+    "price, weight_threshold, price_per_g, cost_percentage.",
+    response_description="The number of created regions and methods",
+    response_model=BulkImportResponse,
+    status_code=HTTPStatus.CREATED,
+)
+async def api_import_config_csv(
+    request: Request,
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> BulkImportResponse:
+    try:
+        data = parse_import_csv((await request.body()).decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+    return await api_import_config(data, account_id)
+
+
+@shipping_api_router.get(
+    "/api/v1/cache/stats",
+    name="Cache Stats",
+    summary="Size and hit/miss counters of the pricing caches.",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_cache_stats() -> dict[str, CacheStats]:
+    return {"snapshots": pricing_cache.stats(), "quotes": quote_cache.stats()}
+
+
+@shipping_api_router.get(
+    "/api/v1/invoices/stats",
+    name="Invoice Worker Stats",
+    summary="Queue depth and handling latency of the paid invoice workers.",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_invoice_worker_stats() -> InvoiceWorkerStats:
+    return invoice_pool.stats()
+
+
+@shipping_api_router.get(
+    "/api/v1/metrics",
+    name="Metrics",
+    summary="Per-endpoint latency histograms and DB query counts.",
+    description="Collected only while SHIPPING_INSTRUMENTATION is enabled.",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_metrics(
+    metrics_format: Literal["prometheus", "json"] = Query("prometheus", alias="format"),
+) -> Response:
+    if metrics_format == "json":
+        return JSONResponse(content=metrics_json())
+    return Response(content=metrics_prometheus(), media_type="text/plain; version=0.0.4")
+
+
 ############################ Settings #############################
 @shipping_api_router.get(
     "/api/v1/settings",
@@ -293,9 +592,14 @@ async def api_calculate_price(
     response_model=ExtensionSettings,
 )
 async def api_get_settings(
+    request: Request,
+    response: Response,
     account_id: AccountId = Depends(check_account_id_exists),
-) -> ExtensionSettings:
+) -> ExtensionSettings | Response:
     user_id = "admin" if ExtensionSettings.is_admin_only() else account_id.id
+    not_modified = _not_modified(request, response, config_etag(user_id, "settings"))
+    if not_modified:
+        return not_modified
     return await get_settings(user_id)
 
 